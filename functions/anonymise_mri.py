@@ -6,16 +6,49 @@ Anonymize DICOM data
 """
 
 import os
+import queue
 import shutil
 import json
+import marshal
+import multiprocessing
+import threading
+import zipfile
 
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from functools import wraps
-from typing import Any, Dict, List, Tuple, Union
+from functools import lru_cache, partial, wraps
+from io import BytesIO
+from itertools import repeat
+from multiprocessing.sharedctypes import Synchronized
+from typing import Any, Dict, List, Set, Tuple, Union
 from pathlib import Path
 
 import pydicom
 
+from functions.utilities import pin_worker
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# posix_fadvise is not available on all platforms (e.g. Windows, macOS)
+_fadvise = hasattr(os, 'posix_fadvise')
+
+# A study of a patient in the mapping. Stored in json as a list of the fields.
+Study = namedtuple('Study', ['patient_name', 'new_patient_name', 'accession_number',
+                             'study_date', 'original_base_folder'])
+
+
+@lru_cache(maxsize=4096)
+def _new_patient_name(given_name: str, family_name: str, patient_index: int,
+                      study_date: str) -> str:
+    # Use 'Z' if there are no initials, as for datasets without a patient name
+    initials = (given_name[:1] + family_name[:1]) or 'Z'
+    return initials + str(patient_index) + '_' + str(study_date)
+
 
 class Anonymisation():
 
@@ -26,12 +59,27 @@ class Anonymisation():
     __study_date_key = 'StudyDate'
     __new_patient_name_key = 'NewPatientName'
     __folder_key = 'OriginalBaseFolder'
+    __studies_key = 'Studies'
+    # Record of the anonymised source files, kept in the target directory
+    __manifest_file_name = '.anon_manifest.json'
+    
+    # Tags needed by extract_key_info(), and the character set to decode names
+    __key_tags = ['SpecificCharacterSet',
+                  __patient_name_key,
+                  __patient_id_key,
+                  __accession_key,
+                  __study_date_key]
     
     __replace_tags = {'PatientBirthDate': '00010101',
                       'PatientID': 'anonymised',
                       'PatientAddress': 'anonymised',
                       'ReferringPhysicianName': 'anonymised'}
     
+    # Replacement tags resolved once to (tag, VR, value)
+    __replace_elements = [(pydicom.datadict.tag_for_keyword(keyword),
+                           pydicom.datadict.dictionary_VR(keyword),
+                           value) for keyword, value in __replace_tags.items()]
+    
     __delete_tags = ['OtherPatientIDs',
                      'OtherPatientNames',
                      'OtherPatientIDsSequence',
@@ -66,9 +114,24 @@ class Anonymisation():
         self.json_directory = Path(json_directory)
         self.source_directory = Path(source_directory)
         self.target_directory = Path(target_directory)
+        # String form used when building the paths of every anonymised file
+        self.target_directory_str = str(self.target_directory)
         
         self.mapping = {}
+        # (patient ID, accession number, study date) of all mapped studies
+        self.mapped_studies = set()
+        # Whether the mapping has changes that are not saved yet
+        self.mapping_modified = False
+        # New patient names of the studies anonymised so far
+        self.study_names = {}
         self.load_json_mapping()
+        # Source files (paths relative to the source directory) anonymised
+        # so far, with their modification time (ns) when anonymised
+        self.manifest = {}
+        self.manifest_kept = False
+        # Whether to advise the kernel on the caching of the anonymised files
+        # (see read_dataset())
+        self.advise = False
     
         self.verbose = verbose
     
@@ -147,10 +210,33 @@ class Anonymisation():
         return selected_list
     
     
+    @staticmethod
+    def scandir(directory: Union[str, Path]):
+        """
+        Wrapper for os.scandir. Retries opening the directory to overcome network
+        instabilities. The returned entries cache the file type, so no extra
+        stat calls are needed to tell files and folders apart.
+
+        Parameters
+        ----------
+        directory : Union[str, Path]
+            Directory to root folder.
+
+        Returns
+        -------
+        Iterator[os.DirEntry]
+            Iterator over the directory entries, to be used as a context manager.
+
+        """
+        exception_repeat_times = 10
+        return Anonymisation.retry_function(exception_repeat_times, os.scandir)(directory)
+    
+    
     @staticmethod
     def isdir(directory: Union[str, Path]) -> bool:
         """
-        Wrapper for os.path.isdir. Repeats isdir call to overcome network instabilities.
+        Wrapper for os.path.isdir. os.path.isdir does not raise on network
+        errors (it returns False), so a single call is made.
 
         Parameters
         ----------
@@ -163,19 +249,14 @@ class Anonymisation():
             True if given path is a directory.
 
         """
-        repeat_times = 40
-        value = False
-        
-        for i in range(repeat_times):
-            value = value or os.path.isdir(directory)
-            
-        return value
+        return os.path.isdir(directory)
     
     
     @staticmethod
     def isfile(directory: Union[str, Path]) -> bool:
         """
-        Wrapper for os.path.isfile. Repeats isflie call to overcome network instabilities.
+        Wrapper for os.path.isfile. os.path.isfile does not raise on network
+        errors (it returns False), so a single call is made.
 
         Parameters
         ----------
@@ -188,17 +269,11 @@ class Anonymisation():
             True if given path is of a file.
 
         """
-        repeat_times = 40
-        value = False
-        
-        for i in range(repeat_times):
-            value = value or os.path.isfile(directory)
-            
-        return value
+        return os.path.isfile(directory)
         
         
     @staticmethod
-    def patient_directory_yield(root_directory: Union[str, Path]) -> Path:
+    def patient_directory_yield(root_directory: Union[str, Path]) -> str:
         """
         Generator of folder directories for the given root path. Expects the
         root directory to contain patient-level folders.
@@ -210,18 +285,18 @@ class Anonymisation():
 
         Yields
         ------
-        Path
+        str
             The full path to a subfolder in the given root directory.
 
         """
-        for patient_folder in Anonymisation.listdir(root_directory):
-            patient_directory = os.path.join(root_directory, patient_folder)
-            if Anonymisation.isdir(patient_directory):
-                yield Path(patient_directory)
+        with Anonymisation.scandir(root_directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield entry.path
         
 
     @staticmethod
-    def sequence_directory_yield(patient_directory: Union[str, Path]) -> Path:
+    def sequence_directory_yield(patient_directory: Union[str, Path]) -> str:
         """
         Generator of folder directories for the given patient path. Expects the
         root directory to contain folders with scan series for a specific patient.
@@ -233,18 +308,18 @@ class Anonymisation():
 
         Yields
         ------
-        Path
+        str
             The full path to a subfolder in the given patient directory.
 
         """
-        for sequence_folder in Anonymisation.listdir(patient_directory):
-            sequence_directory = os.path.join(patient_directory, sequence_folder)
-            if Anonymisation.isdir(sequence_directory):
-                yield Path(sequence_directory)         
+        with Anonymisation.scandir(patient_directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield entry.path
 
 
     @staticmethod
-    def dicom_directory_yield(sequence_directory: Union[str, Path]) -> Path:
+    def dicom_directory_yield(sequence_directory: Union[str, Path]) -> str:
         """
         Generator of DICOM file directories for the given dicom folder path.
         Expects the DICOM folder (patient scan series) to contain DICOM files.
@@ -257,15 +332,188 @@ class Anonymisation():
 
         Yields
         ------
-        Path
+        str
             The full path to a DICOM file in the given DICOM (patient series)
             folder.
 
         """
-        for dicom_file in Anonymisation.listdir(sequence_directory):
-            dicom_directory = os.path.join(sequence_directory, dicom_file)
-            if Anonymisation.isfile(dicom_directory) and dicom_file.endswith('.dcm'):
-                yield dicom_directory
+        with Anonymisation.scandir(sequence_directory) as entries:
+            for entry in entries:
+                # Check the name first as it does not require a stat call
+                if entry.name.endswith('.dcm') and entry.is_file():
+                    yield entry.path
+
+
+    @staticmethod
+    def dicom_file_times(patient_directory: Union[str, Path]) -> Dict[str, int]:
+        """
+        Returns the modification times of all DICOM files of a patient
+        directory (see sequence_directory_yield() and dicom_directory_yield()).
+
+        Parameters
+        ----------
+        patient_directory : Union[str, Path]
+            The directory of the patient folder containing the scan series.
+
+        Returns
+        -------
+        Dict[str, int]
+            The full paths to the DICOM files as keys and their modification
+            times (in nanoseconds) as values.
+
+        """
+        file_times = {}
+        for sequence_directory in Anonymisation.sequence_directory_yield(patient_directory):
+            with Anonymisation.scandir(sequence_directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.dcm') and entry.is_file():
+                        file_times[entry.path] = entry.stat().st_mtime_ns
+                        
+        return file_times
+    
+    
+    @staticmethod
+    def dataset_prefetch_yield(sequence_directory: Union[str, Path], read_dicom,
+                               prefetch: int = 4,
+                               dicom_files: Union[Set[str], None] = None) -> Tuple[str, pydicom.Dataset]:
+        """
+        Generator of the DICOM files of a sequence folder together with their
+        datasets. The files are read by a background thread up to 'prefetch'
+        files ahead, so reading the next file overlaps with processing the
+        current one.
+
+        Parameters
+        ----------
+        sequence_directory : Union[str, Path]
+            The directory to the DICOM folder (see dicom_directory_yield()).
+        read_dicom : TYPE
+            Function used to read a DICOM file, called as
+            read_dicom(path, force=True).
+        prefetch : int, optional
+            The maximum number of datasets read ahead. The default is 4.
+        dicom_files : Union[Set[str], None], optional
+            The full paths of the DICOM files to read, the other files of the
+            folder are skipped. The default is None, which reads all files.
+
+        Yields
+        ------
+        Tuple[str, pydicom.Dataset]
+            The full path to a DICOM file and its dataset.
+
+        """
+        datasets = queue.Queue(maxsize=prefetch)
+        # Set when the generator is closed, e.g. when the consumer stops early
+        # or raises, so the reader does not wait for a free slot forever
+        stop = threading.Event()
+        
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    datasets.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        def read_datasets():
+            try:
+                for dicom_file in Anonymisation.dicom_directory_yield(sequence_directory):
+                    if stop.is_set():
+                        return
+                    if dicom_files is not None and dicom_file not in dicom_files:
+                        continue
+                    if not put((dicom_file, read_dicom(dicom_file, force=True))):
+                        return
+            except Exception as e:
+                put(e)
+            # End of the sequence folder
+            put(None)
+        
+        reader = threading.Thread(target=read_datasets, daemon=True)
+        reader.start()
+        
+        try:
+            while True:
+                item = datasets.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            reader.join()
+            # Release the datasets read ahead
+            while not datasets.empty():
+                datasets.get_nowait()
+        
+        
+    @staticmethod
+    def read_dataset(file_path: Union[str, Path], advise: bool = False, **kwargs) -> pydicom.Dataset:
+        """
+        Reads a DICOM file (see pydicom.dcmread()). Optionally, the kernel is
+        advised that the file is read sequentially and, once read, that its
+        pages are not needed in the page cache anymore, as each source file is
+        read only once. This keeps large executions from filling the page
+        cache with pixel data. The advice is only given where supported.
+
+        Parameters
+        ----------
+        file_path : Union[str, Path]
+            Path of the DICOM file to read.
+        advise : bool, optional
+            Whether to advise the kernel on the file caching. The default is
+            False.
+        **kwargs
+            Keyword arguments passed to pydicom.dcmread().
+
+        Returns
+        -------
+        pydicom.Dataset
+            The read DICOM dataset.
+
+        """
+        with open(file_path, 'rb') as fp:
+            if advise and _fadvise:
+                os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            dataset = pydicom.dcmread(fp, **kwargs)
+            if advise and _fadvise:
+                os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                
+        return dataset
+        
+        
+    @staticmethod
+    def save_dataset(dataset: pydicom.Dataset, file_path: Union[str, Path],
+                     advise: bool = False) -> None:
+        """
+        Saves the DICOM dataset to the given file. The dataset is first encoded
+        in memory and then written with a single write call, instead of the many
+        small writes pydicom issues per data element.
+
+        Parameters
+        ----------
+        dataset : pydicom.Dataset
+            The DICOM dataset to save.
+        file_path : Union[str, Path]
+            Path of the file to write.
+        advise : bool, optional
+            Whether to advise the kernel that the pages of the written file are
+            not needed in the page cache (see read_dataset()). The default is
+            False.
+
+        Returns
+        -------
+        None
+
+        """
+        buffer = BytesIO()
+        dataset.save_as(buffer)
+        with open(file_path, 'wb') as fp:
+            fp.write(buffer.getbuffer())
+            if advise and _fadvise:
+                fp.flush()
+                os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
 
 
     def save_json_mapping(self) -> None:
@@ -273,6 +521,10 @@ class Anonymisation():
         Saves as a json format the mapping between the original and the anonymised
         metadata. Stored information is also required to guarantee that the same
         patients are given the same unique anonymised ID.
+        
+        The mapping is written to a temporary file which then replaces the
+        json file, so an interrupted save never leaves a truncated mapping.
+        orjson is used for encoding when installed, otherwise the json module.
 
         Returns
         -------
@@ -281,8 +533,90 @@ class Anonymisation():
         """
         retry_times = 20
         Anonymisation.retry_function(retry_times, os.makedirs)(os.path.dirname(os.path.abspath(self.json_directory)), exist_ok=True)
-        with open(self.json_directory, 'w') as fp:
-            Anonymisation.retry_function(retry_times, json.dump)(self.mapping, fp)
+        temporary_file = str(self.json_directory) + '.tmp'
+        if orjson is not None:
+            # Studies are namedtuples, which are written as json arrays
+            data = orjson.dumps(self.mapping, default=list, option=orjson.OPT_NON_STR_KEYS)
+            with open(temporary_file, 'wb') as fp:
+                fp.write(data)
+                fp.flush()
+                os.fsync(fp.fileno())
+        else:
+            with open(temporary_file, 'w') as fp:
+                json.dump(self.mapping, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+        os.replace(temporary_file, self.json_directory)
+        self.mapping_modified = False
+        self.__save_mapping_cache()
+    
+    
+    def __mapping_cache_file(self) -> str:
+        # Next to the json file, e.g. 'record_linkage.cache'
+        return str(self.json_directory.with_suffix('.cache'))
+    
+    
+    def __save_mapping_cache(self) -> None:
+        # The mapping is cached with marshal, together with the modification
+        # time and size of the json file it matches. Unlike pickle, loading
+        # marshal data does not run code, and it only holds the plain
+        # containers and strings of the json layout.
+        mapping = {str(patient_id): {self.__index_key: int(patient_values[self.__index_key]),
+                                     self.__studies_key: [[None if value is None else str(value)
+                                                           for value in study]
+                                                          for study in patient_values[self.__studies_key]]}
+                   for patient_id, patient_values in self.mapping.items()}
+        json_stat = os.stat(self.json_directory)
+        cache_file = self.__mapping_cache_file()
+        temporary_file = cache_file + '.tmp'
+        with open(temporary_file, 'wb') as fp:
+            marshal.dump((json_stat.st_mtime_ns, json_stat.st_size, mapping), fp)
+        os.replace(temporary_file, cache_file)
+        
+        
+    def __load_mapping_cache(self) -> bool:
+        # Loads the cached mapping if it matches the json file, returning
+        # whether it was loaded
+        cache_file = self.__mapping_cache_file()
+        if not os.path.isfile(cache_file):
+            return False
+        
+        json_stat = os.stat(self.json_directory)
+        try:
+            with open(cache_file, 'rb') as fp:
+                json_modified_time, json_size, mapping = marshal.load(fp)
+            if json_modified_time != json_stat.st_mtime_ns or json_size != json_stat.st_size:
+                return False
+            self.__set_mapping(mapping)
+        except Exception:
+            # An unreadable cache is rebuilt from the json file
+            return False
+        
+        return True
+    
+    
+    def __set_mapping(self, mapping: Dict[str, Dict[str, Any]]) -> None:
+        # Sets the mapping from its json layout, with the studies as Study
+        # tuples, and the set of the mapped studies
+        mapped_studies = set()
+        for patient_id, patient_values in mapping.items():
+            if self.__studies_key in patient_values:
+                studies = [Study(*study) for study in patient_values[self.__studies_key]]
+            else:
+                # Mapping saved with one list per study field
+                studies = [Study(*study) for study in zip(patient_values[self.__patient_name_key],
+                                                          patient_values[self.__new_patient_name_key],
+                                                          patient_values[self.__accession_key],
+                                                          patient_values[self.__study_date_key],
+                                                          patient_values[self.__folder_key])]
+                
+            mapping[patient_id] = {self.__index_key: patient_values[self.__index_key],
+                                   self.__studies_key: studies}
+            for study in studies:
+                mapped_studies.add((patient_id, study.accession_number, study.study_date))
+                
+        self.mapping = mapping
+        self.mapped_studies = mapped_studies
     
     
     def load_json_mapping(self) -> None:
@@ -290,6 +624,10 @@ class Anonymisation():
         Loads the json file that contains the mapping betwen the original and
         the anonymised metadata, if it exists. A copy of the file is made with
         the date appended.
+        
+        The loaded mapping is cached in a marshal file next to the json file
+        (e.g. 'record_linkage.cache'), which is used instead of parsing the json
+        file again as long as the json file is not modified.
 
         Returns
         -------
@@ -304,10 +642,74 @@ class Anonymisation():
             target_file_name = self.json_directory.stem + '_' + timestamp + self.json_directory.suffix
             shutil.copy(self.json_directory, os.path.join(path, target_file_name))
             
-            with open(self.json_directory, 'r') as fp:
-                self.mapping = Anonymisation.retry_function(retry_times, json.load)(fp)
+            if self.__load_mapping_cache():
+                return
+            
+            if orjson is not None:
+                with open(self.json_directory, 'rb') as fp:
+                    data = Anonymisation.retry_function(retry_times, fp.read)()
+                mapping = orjson.loads(data)
+            else:
+                with open(self.json_directory, 'r') as fp:
+                    mapping = Anonymisation.retry_function(retry_times, json.load)(fp)
+                
+            self.__set_mapping(mapping)
+            self.__save_mapping_cache()
     
 
+    def __record_files(self, file_times: Dict[str, int], source_prefix: str) -> None:
+        # Adds the anonymised source files to the manifest
+        for dicom_file, modification_time in file_times.items():
+            self.manifest[dicom_file[len(source_prefix):]] = modification_time
+        
+        
+    def save_manifest(self) -> None:
+        """
+        Saves the record of the anonymised source files (see load_manifest())
+        in the target directory. As with the mapping, it is written to a
+        temporary file which then replaces the manifest file.
+
+        Returns
+        -------
+        None
+
+        """
+        retry_times = 20
+        Anonymisation.retry_function(retry_times, os.makedirs)(self.target_directory, exist_ok=True)
+        manifest_file = os.path.join(self.target_directory_str, self.__manifest_file_name)
+        temporary_file = manifest_file + '.tmp'
+        if orjson is not None:
+            with open(temporary_file, 'wb') as fp:
+                fp.write(orjson.dumps(self.manifest))
+        else:
+            with open(temporary_file, 'w') as fp:
+                json.dump(self.manifest, fp)
+        os.replace(temporary_file, manifest_file)
+        
+        
+    def load_manifest(self) -> None:
+        """
+        Loads the record of the source files anonymised by previous executions
+        from the target directory ('.anon_manifest.json'), if it exists. It
+        maps the paths of the source files, relative to the source directory,
+        to their modification times (in nanoseconds) when they were anonymised.
+
+        Returns
+        -------
+        None
+
+        """
+        manifest_file = os.path.join(self.target_directory_str, self.__manifest_file_name)
+        if not Anonymisation.isfile(manifest_file):
+            self.manifest = {}
+        elif orjson is not None:
+            with open(manifest_file, 'rb') as fp:
+                self.manifest = orjson.loads(fp.read())
+        else:
+            with open(manifest_file, 'r') as fp:
+                self.manifest = json.load(fp)
+        
+        
     def extract_key_info(self, dataset: pydicom.Dataset) -> Dict[str, Any]:
         """
         Retrieves key information from the DICOM tags:
@@ -378,23 +780,14 @@ class Anonymisation():
             otherwise.
 
         """
-        if patient_info[self.__patient_id_key] not in self.mapping:
-            return False
+        study = (patient_info[self.__patient_id_key],
+                 patient_info[self.__accession_key],
+                 patient_info[self.__study_date_key])
         
-        patient_values = self.mapping[patient_info[self.__patient_id_key]]
-
-        accesion_study_list = zip(patient_values[self.__accession_key],
-                                   patient_values[self.__study_date_key])
-
-        for stored_accession_number, stored_study_date in accesion_study_list:
-            if (stored_accession_number == patient_info[self.__accession_key] and
-                stored_study_date == patient_info[self.__study_date_key]):
-                return True
-            
-        return False
+        return study in self.mapped_studies
 
     
-    def initialise_mapping_entry(self, patient_id: str) -> None:
+    def initialise_mapping_entry(self, patient_id: str) -> Dict[str, Any]:
         """
         Initialises the mapping entry for every new patient (based on the patient
         ID). Initialisation constists of creating deafult/empty values for all
@@ -408,18 +801,19 @@ class Anonymisation():
 
         Returns
         -------
-        None
+        Dict[str, Any]
+            The (new or existing) mapping entry of the patient.
 
         """
-        if patient_id in self.mapping:
-            return None
+        patient_values = self.mapping.get(patient_id)
+        if patient_values is not None:
+            return patient_values
         
-        self.mapping[patient_id] = {self.__index_key: None,
-                                    self.__patient_name_key: [],
-                                    self.__new_patient_name_key: [],
-                                    self.__accession_key: [],
-                                    self.__study_date_key: [],
-                                    self.__folder_key: []}
+        patient_values = {self.__index_key: None,
+                          self.__studies_key: []}
+        self.mapping[patient_id] = patient_values
+        
+        return patient_values
         
 
     def get_patient_index(self, patient_info: Dict[str, Any]) -> int:
@@ -437,10 +831,10 @@ class Anonymisation():
             Unique index for the given patient ID.
 
         """
-        patient_id = patient_info[self.__patient_id_key]
+        patient_index = self.mapping[patient_info[self.__patient_id_key]][self.__index_key]
         
-        if self.mapping[patient_id][self.__index_key] is not None:
-            return self.mapping[patient_id][self.__index_key]
+        if patient_index is not None:
+            return patient_index
         
         return len(self.mapping)
 
@@ -467,11 +861,8 @@ class Anonymisation():
             The new anonymised patient name that uniquely identifies the patient.
 
         """
-        try:
-            new_patient_name = patient_name.given_name[0] + patient_name.family_name[0]
-        except:
-            new_patient_name = patient_name.family_name[0]
-        return new_patient_name + str(patient_index) + '_' + str(study_date)
+        return _new_patient_name(patient_name.given_name or '', patient_name.family_name or '',
+                                 patient_index, study_date)
         
 
     def add_to_mapping(self, patient_info: Dict[str, Any]) -> str:
@@ -491,9 +882,8 @@ class Anonymisation():
             Anonymised unique patient ID.
 
         """
-        self.initialise_mapping_entry(patient_info[self.__patient_id_key])
+        patient_values = self.initialise_mapping_entry(patient_info[self.__patient_id_key])
         
-        patient_id = patient_info[self.__patient_id_key]
         patient_index = self.get_patient_index(patient_info)
         patient_name = patient_info[self.__patient_name_key]
         study_date = patient_info[self.__study_date_key]
@@ -504,12 +894,12 @@ class Anonymisation():
         if self.exists_in_mapping(patient_info):
             return new_patient_name
         
-        self.mapping[patient_id][self.__index_key] = patient_index
-        self.mapping[patient_id][self.__patient_name_key].append(str(patient_name))
-        self.mapping[patient_id][self.__new_patient_name_key].append(new_patient_name)
-        self.mapping[patient_id][self.__study_date_key].append(study_date)
-        self.mapping[patient_id][self.__accession_key].append(accession_number)
-        self.mapping[patient_id][self.__folder_key].append(folder_name)
+        patient_values[self.__index_key] = patient_index
+        patient_values[self.__studies_key].append(Study(str(patient_name), new_patient_name,
+                                                        accession_number, study_date,
+                                                        folder_name))
+        self.mapped_studies.add((patient_info[self.__patient_id_key], accession_number, study_date))
+        self.mapping_modified = True
     
         return new_patient_name
 
@@ -533,8 +923,16 @@ class Anonymisation():
             The unique anonymised patient ID.
 
         """
-        patient_info = self.extract_key_info(dataset)
-        new_patient_name = self.add_to_mapping(patient_info)
+        # The new patient name only depends on the study, so the mapping is
+        # only consulted for the first file of each study
+        study = (dataset.data_element(self.__patient_id_key).value,
+                 dataset.data_element(self.__accession_key).value,
+                 dataset.data_element(self.__study_date_key).value)
+        new_patient_name = self.study_names.get(study)
+        if new_patient_name is None:
+            patient_info = self.extract_key_info(dataset)
+            new_patient_name = self.add_to_mapping(patient_info)
+            self.study_names[study] = new_patient_name
         
         # Change patient name
         try:
@@ -543,11 +941,8 @@ class Anonymisation():
             dataset.PatientName = new_patient_name
         
         # Replace sensitive tags
-        for field, value in self.__replace_tags.items():
-            try:
-                dataset.data_element(field).value = value
-            except:
-                dataset.add_new(field, 'CS', value)
+        for tag, vr, value in self.__replace_elements:
+            dataset[tag] = pydicom.DataElement(tag, vr, value)
         
         # Remove optional sensitive tags
         for field in self.__delete_tags:
@@ -558,19 +953,198 @@ class Anonymisation():
         try:
             dataset.remove_private_tags()
         except:
-            # Try deleting individually the private tags and skip over the
-            # faulty case (incorrectly populated tag)
-            for tag in list(dataset._dict):
-                if tag.is_private:
-                    try:
-                        del dataset[tag]
-                    except:
-                        continue
+            # Delete the private tags (odd group number) directly from the
+            # underlying element dictionary, so that incorrectly populated
+            # tags are not parsed
+            private_tags = [tag for tag in dataset._dict if (tag >> 16) & 1]
+            for tag in private_tags:
+                dataset._dict.pop(tag, None)
         
         return dataset, new_patient_name
     
     
-    def anonymise(self, compress: bool = False) -> None:
+    def read_patient_info(self, patient_directory: Union[str, Path]) -> List[Dict[str, Any]]:
+        """
+        Reads the key patient information (see extract_key_info()) from the
+        headers of all DICOM files of a patient directory. Pixel data is not
+        read and only the tags required for the key information are parsed. The
+        mapping is not modified, so this can run in a worker process.
+
+        Parameters
+        ----------
+        patient_directory : Union[str, Path]
+            The directory of the patient folder containing the scan series.
+
+        Returns
+        -------
+        List[Dict[str, Any]]
+            The unique key-value pairs of the patient metadata information, in
+            the order they were found. The patient name is stored as a string
+            so that the result can be passed between processes.
+
+        """
+        retry_times = 50
+        # Build the retry wrapper once rather than per file
+        read_dicom = Anonymisation.retry_function(retry_times, pydicom.dcmread)
+        
+        patient_infos = []
+        found_studies = set()
+        for sequence_directory in self.sequence_directory_yield(patient_directory):
+            for dicom_file in self.dicom_directory_yield(sequence_directory):
+                dataset = read_dicom(dicom_file, force=True, stop_before_pixels=True,
+                                     specific_tags=self.__key_tags)
+                patient_info = self.extract_key_info(dataset)
+                study = (patient_info[self.__patient_id_key],
+                         patient_info[self.__accession_key],
+                         patient_info[self.__study_date_key])
+                if study in found_studies:
+                    continue
+                
+                found_studies.add(study)
+                patient_info[self.__patient_name_key] = str(patient_info[self.__patient_name_key])
+                patient_infos.append(patient_info)
+                
+        return patient_infos
+    
+    
+    def is_anonymised(self, patient_directory: Union[str, Path]) -> bool:
+        """
+        Checks whether a patient directory was already anonymised by a previous
+        execution, based on its first DICOM file. The patient is considered
+        anonymised if the study of that file exists in the mapping and its
+        anonymised folder (or zip archive) exists in the target directory.
+
+        Parameters
+        ----------
+        patient_directory : Union[str, Path]
+            The directory of the patient folder containing the scan series.
+
+        Returns
+        -------
+        bool
+            True if the patient was already anonymised, False otherwise.
+
+        """
+        retry_times = 50
+        
+        for sequence_directory in self.sequence_directory_yield(patient_directory):
+            for dicom_file in self.dicom_directory_yield(sequence_directory):
+                dataset = Anonymisation.retry_function(retry_times, pydicom.dcmread)(dicom_file, force=True,
+                                                                                      stop_before_pixels=True,
+                                                                                      specific_tags=self.__key_tags)
+                patient_id = dataset.data_element(self.__patient_id_key).value
+                accession_number = dataset.data_element(self.__accession_key).value
+                study_date = dataset.data_element(self.__study_date_key).value
+                if (patient_id, accession_number, study_date) not in self.mapped_studies:
+                    return False
+                
+                for study in self.mapping[patient_id][self.__studies_key]:
+                    if study.accession_number == accession_number and study.study_date == study_date:
+                        target_folder = os.path.join(self.target_directory_str, study.new_patient_name)
+                        return (os.path.isdir(target_folder) or
+                                os.path.isfile(target_folder + '.zip'))
+                    
+                return False
+            
+        return False
+    
+    
+    def anonymise_patient(self, patient_directory: Union[str, Path], compress: bool = False,
+                          dicom_files: Union[Set[str], None] = None) -> None:
+        """
+        Anonymises all DICOM files of a patient directory and saves them in the
+        target directory. The patient studies are expected to already be in the
+        mapping (see read_patient_info()), so the mapping is not modified and
+        this can run in a worker process.
+
+        Parameters
+        ----------
+        patient_directory : Union[str, Path]
+            The directory of the patient folder containing the scan series.
+        compress : bool, optional
+            Whether to save the anonymised files in a zip archive per patient
+            ('<target>/<new patient name>.zip') instead of a folder. The default
+            is False.
+        dicom_files : Union[Set[str], None], optional
+            The full paths of the DICOM files to anonymise, the other files of
+            the patient are skipped. The files are then added to any existing
+            patient folders. Ignored when compressing, as the members of a zip
+            archive cannot be replaced, so the patient archives are always
+            written again with all files. The default is None, which anonymises
+            all files.
+
+        Returns
+        -------
+        None
+
+        """
+        retry_times = 50
+        # Writes are handed to a thread pool so that reading and anonymising
+        # the next file overlaps with saving the previous ones
+        write_threads = 4
+        max_pending_writes = 32
+        # Build the retry wrappers once rather than per file
+        read_dicom = Anonymisation.retry_function(retry_times, partial(Anonymisation.read_dataset,
+                                                                      advise=self.advise))
+        save_dataset = Anonymisation.retry_function(retry_times, partial(Anonymisation.save_dataset,
+                                                                        advise=self.advise))
+        
+        if compress:
+            dicom_files = None
+        
+        if self.verbose == 1:
+            print('Anonymising directory {}'.format(patient_directory))
+        target_folders = {}
+        archives = {}
+        with ThreadPoolExecutor(max_workers=write_threads) as writer:
+            pending_writes = deque()
+            try:
+                for sequence_directory in self.sequence_directory_yield(patient_directory):
+                    sequence_name = os.path.basename(sequence_directory)
+                    
+                    for dicom_file, dataset in self.dataset_prefetch_yield(sequence_directory, read_dicom,
+                                                                           dicom_files=dicom_files):
+                        # Anonymise
+                        dataset, new_name = self.anonymise_dicom(dataset)
+                        file_name = sequence_name + '_' + os.path.basename(dicom_file)
+                        
+                        if compress:
+                            # Write the anonymised DICOM file straight into the
+                            # patient archive, without staging it on disk. Pixel
+                            # data is usually already encoded, so it is stored.
+                            archive = archives.get(new_name)
+                            if archive is None:
+                                Anonymisation.retry_function(retry_times, os.makedirs)(self.target_directory, exist_ok=True)
+                                archive = zipfile.ZipFile(os.path.join(self.target_directory_str, new_name + '.zip'),
+                                                          'w', zipfile.ZIP_STORED)
+                                archives[new_name] = archive
+                            buffer = BytesIO()
+                            dataset.save_as(buffer)
+                            archive.writestr(file_name, buffer.getvalue())
+                            continue
+                        
+                        # Create the target folder once per anonymised patient name
+                        target_folder = target_folders.get(new_name)
+                        if target_folder is None:
+                            target_folder = os.path.join(self.target_directory_str, new_name)
+                            Anonymisation.retry_function(retry_times, os.makedirs)(target_folder, exist_ok=True)
+                            target_folders[new_name] = target_folder
+                        # Save the anonymised DICOM file to target directory
+                        pending_writes.append(writer.submit(save_dataset, dataset,
+                                                            os.path.join(target_folder, file_name)))
+                        if len(pending_writes) >= max_pending_writes:
+                            pending_writes.popleft().result()
+            finally:
+                for archive in archives.values():
+                    archive.close()
+            
+            # Wait for the remaining writes, raising any write errors
+            for pending_write in pending_writes:
+                pending_write.result()
+    
+    
+    def anonymise(self, compress: bool = False, workers: Union[int, None] = None,
+                  incremental: bool = True, advise: bool = True, pin: bool = False) -> None:
         """
         Anonymises all patient datasets in the root directory, as set during
         the class constructor. A json file is created to keep record of the link
@@ -578,38 +1152,155 @@ class Anonymisation():
         persistence across different executions of the anonymisation script
         and across different datasets.
         
-        The anonymised DICOM datasets are compressed (zipped).
+        Patients are processed in parallel in two passes. First the DICOM
+        headers are read to add all patient studies to the mapping, in the same
+        order as a sequential run would, and the mapping is saved. Then the
+        DICOM files are anonymised and saved against the completed mapping.
+        
+        The anonymised source files are recorded, with their modification
+        times, in a manifest in the target directory (see load_manifest()). In
+        an incremental execution only the files that are new or modified since
+        they were anonymised are processed, so an interrupted run can be
+        resumed and new files of a patient are added to its anonymised data.
+        Patients anonymised by an execution without a manifest (see
+        is_anonymised()) are skipped.
+        
+        The anonymised DICOM datasets are optionally compressed (zipped). The
+        archives of a patient with any new or modified files are then written
+        again with all the patient files.
+
+        Parameters
+        ----------
+        compress : bool, optional
+            Whether to save the anonymised files in a zip archive per patient
+            instead of a folder. The default is False.
+        workers : Union[int, None], optional
+            The number of worker processes. The default is None, which uses
+            the number of processors on the machine.
+        incremental : bool, optional
+            Whether to skip the files already anonymised by a previous
+            execution. The default is True.
+        advise : bool, optional
+            Whether to advise the kernel that the source and anonymised files
+            do not need to stay in the page cache (see read_dataset()). The
+            default is True.
+        pin : bool, optional
+            Whether to pin each worker process to a single processor (see
+            utilities.pin_worker()). The default is False.
 
         Returns
         -------
         None
 
         """
-        retry_times = 50
+        if workers is None:
+            workers = os.cpu_count()
+        self.advise = advise
+            
+        self.load_manifest()
+        # Prefix of the source file paths, removed for the manifest keys
+        source_prefix = os.path.join(str(self.source_directory), '')
+        # Empty before the first execution that keeps a manifest
+        self.manifest_kept = len(self.manifest) > 0
         
-        for patient_directory in self.patient_directory_yield(self.source_directory):
-            if self.verbose == 1:
-                print('Anonymising directory {}'.format(patient_directory))
-            new_name = None
-            for sequence_directory in self.sequence_directory_yield(patient_directory):
-                sequence_name = os.path.basename(sequence_directory)
+        patient_directories = list(self.patient_directory_yield(self.source_directory))
+        
+        # Add all patient studies to the mapping in directory order, skipping
+        # the patients with no files left to anonymise
+        new_patient_directories = []
+        new_patient_files = []
+        # The files to anonymise of each patient, None for all of them
+        new_patient_file_sets = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=_initialise_worker,
+                                 initargs=(self, _worker_counter(pin))) as executor:
+            for patient_directory, patient_result in zip(patient_directories,
+                                                         executor.map(_read_patient_info,
+                                                                      patient_directories,
+                                                                      repeat(incremental))):
+                if patient_result is None:
+                    if self.verbose == 1:
+                        print('Skipping already anonymised directory {}'.format(patient_directory))
+                    continue
                 
-                for dicom_file in self.dicom_directory_yield(sequence_directory):
-                    # Read and anonymise
-                    dataset = Anonymisation.retry_function(retry_times, pydicom.dcmread)(dicom_file, force=True)
-                    dataset, new_name = self.anonymise_dicom(dataset)
-                    # Save the anonymised DICOM file to target directory
-                    Anonymisation.retry_function(retry_times, os.makedirs)(os.path.join(self.target_directory, new_name), exist_ok=True)
-                    file_name = sequence_name + '_' + os.path.basename(dicom_file)
-                    Anonymisation.retry_function(retry_times, dataset.save_as)(os.path.join(self.target_directory, new_name, file_name))
-            
-            # Compress the anonymised patient directory
-            if compress:
-                shutil.make_archive(new_name, 'zip', os.path.join(self.target_directory, new_name),
-                                    os.path.join(self.target_directory, new_name))
-                shutil.rmtree(os.path.join(self.target_directory, new_name))
-            
+                patient_infos, file_times, all_files = patient_result
+                if patient_infos is None:
+                    # Anonymised by an execution without a manifest, so its
+                    # files are only recorded
+                    if self.verbose == 1:
+                        print('Skipping already anonymised directory {}'.format(patient_directory))
+                    self.__record_files(file_times, source_prefix)
+                    continue
+                
+                new_patient_directories.append(patient_directory)
+                new_patient_files.append(file_times)
+                new_patient_file_sets.append(None if all_files else set(file_times))
+                for patient_info in patient_infos:
+                    patient_name = patient_info[self.__patient_name_key]
+                    patient_info[self.__patient_name_key] = pydicom.valuerep.PersonName(patient_name)
+                    self.add_to_mapping(patient_info)
+        
+        if self.mapping_modified:
             self.save_json_mapping()
+        
+        # The workers receive a copy of the completed mapping
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_initialise_worker,
+                                     initargs=(self, _worker_counter(pin))) as executor:
+                for file_times, _ in zip(new_patient_files,
+                                         executor.map(_anonymise_patient, new_patient_directories,
+                                                      repeat(compress), new_patient_file_sets)):
+                    self.__record_files(file_times, source_prefix)
+        finally:
+            # The patients anonymised so far are recorded even if interrupted
+            self.save_manifest()
+
+
+# Anonymisation instance of a worker process, set by _initialise_worker()
+_worker_anonymisation = None
+
+
+def _worker_counter(pin: bool) -> Union[Synchronized, None]:
+    # The started workers counter of a pool, if its workers are pinned
+    return multiprocessing.Value('i', 0) if pin else None
+
+
+def _initialise_worker(anonymisation: Anonymisation,
+                       worker_counter: Union[Synchronized, None] = None) -> None:
+    global _worker_anonymisation
+    _worker_anonymisation = anonymisation
+    if worker_counter is not None:
+        pin_worker(worker_counter)
+    
+    
+def _read_patient_info(patient_directory: str,
+                       incremental: bool) -> Union[Tuple[List[Dict[str, Any]], Dict[str, int], bool], None]:
+    # Returns the key information of the patient, the files to anonymise with
+    # their modification times and whether these are all the patient files,
+    # or None if there are no files to anonymise. The key information is None
+    # for a patient anonymised by an execution without a manifest.
+    anonymisation = _worker_anonymisation
+    file_times = anonymisation.dicom_file_times(patient_directory)
+    files_num = len(file_times)
+    if incremental:
+        source_prefix = os.path.join(str(anonymisation.source_directory), '')
+        pending_times = {dicom_file: modification_time
+                         for dicom_file, modification_time in file_times.items()
+                         if anonymisation.manifest.get(dicom_file[len(source_prefix):]) != modification_time}
+        if not pending_times:
+            return None
+        # Patients anonymised before the manifest was kept
+        if (not anonymisation.manifest_kept and len(pending_times) == len(file_times) and
+            anonymisation.is_anonymised(patient_directory)):
+            return None, file_times, True
+        file_times = pending_times
+        
+    return (anonymisation.read_patient_info(patient_directory), file_times,
+            len(file_times) == files_num)
+
+
+def _anonymise_patient(patient_directory: str, compress: bool,
+                       dicom_files: Union[Set[str], None]) -> None:
+    _worker_anonymisation.anonymise_patient(patient_directory, compress, dicom_files)
 
 
 if __name__ == '__main__':
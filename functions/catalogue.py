@@ -1,8 +1,13 @@
+import io
 import os
 import re
 import shutil
 
-from typing import Any, Dict, List, Union
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from typing import Any, DefaultDict, Dict, FrozenSet, Iterator, List, Set, Tuple, Union
 from pathlib import Path
 
 import pandas as pd
@@ -11,64 +16,76 @@ import png
 
 import pydicom
 
-import matplotlib.pyplot as plt
+# The plots are only saved to files, so the figures are drawn on an Agg canvas
+# directly, without going through pyplot's figure manager
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 from functions.cataloguing.group import Categories
 from functions.cataloguing.split import MetadataSplit
+from functions.utilities import read_dicom_header
+
+
+# The sequence descriptions repeat across patients, so the repeat checks are
+# cached (get_label caches its own classification)
+_is_repeat_cached = lru_cache(maxsize=1024)(Categories.is_repeat)
 
 
-_dicom_tags = ['MRAcquisitionType', 'SliceThickness', 'RepetitionTime', 'EchoTime',
+_dicom_tags = ('MRAcquisitionType', 'SliceThickness', 'RepetitionTime', 'EchoTime',
                'NumberOfAverages', 'SpacingBetweenSlices', 'EchoTrainLength',
                'FlipAngle', 'PixelSpacing', 'AcquisitionMatrix', 'Rows', 'Columns',
-               'MagneticFieldStrength']
+               'MagneticFieldStrength')
+
+_mr_acquisition_digits = re.compile(r'\d+')
 
 
 def sequence_count() -> pd.DataFrame:
-    df = pd.read_csv('patient_sequences.csv')
-    df = df.drop(columns=['Dataset'])
-    data = np.asarray(df.sum())
-    
-    data = {'Sequence': df.columns, 'Count': data}
-    df = pd.DataFrame.from_dict(data)
-    df.sort_values(by=['Count'], inplace=True, ascending=False)
+    counts = pd.read_csv('patient_sequences.csv').drop(columns=['Dataset']).sum(axis=0)
+    df = counts.sort_values(ascending=False).rename_axis('Sequence').reset_index(name='Count')
     
     return df
     
 
 def __dicom_to_png(input_path, output_path, output_filename):
     os.makedirs(output_path, exist_ok=True)
-    all_files = os.listdir(input_path)
+    with os.scandir(input_path) as entries:
+        all_files = [entry.name for entry in entries if entry.is_file()]
     middle_index = int(len(all_files) / 2)
-    filename = os.listdir(input_path)[middle_index]
+    filename = all_files[middle_index]
     dicom_file = pydicom.dcmread(os.path.join(input_path, filename))
     
-    shape = dicom_file.pixel_array.shape
+    image_2d = dicom_file.pixel_array
+    shape = image_2d.shape
 
-    # Convert to float to avoid overflow or underflow losses.
-    image_2d = dicom_file.pixel_array.astype(float)
-    
-    # Rescaling grey scale between 0-255
-    image_2d_scaled = (np.maximum(image_2d, 0) / image_2d.max()) * 255.0
+    # Rescaling grey scale between 0-255. A single float32 buffer is used for
+    # the clipping and scaling to avoid overflow or underflow losses.
+    max_value = image_2d.max()
+    scale = np.float32(255.0 / max_value) if max_value > 0 else np.float32(0)
+    image_2d_scaled = np.clip(image_2d, 0, None).astype(np.float32, copy=False)
+    np.multiply(image_2d_scaled, scale, out=image_2d_scaled)
     
     # Convert to uint
-    image_2d_scaled = np.uint8(image_2d_scaled)
+    image_2d_scaled = image_2d_scaled.astype(np.uint8)
     
-    # Write the PNG file
-    with open(os.path.join(output_path, output_filename), 'wb') as png_file:
-        w = png.Writer(shape[1], shape[0], greyscale=True)
-        w.write(png_file, image_2d_scaled)
+    # Write the PNG file. The rows are handed to the encoder as bytes, which it
+    # copies in one go, instead of iterating over each pixel of the array rows,
+    # and the file is buffered to hold the whole image
+    image_bytes = image_2d_scaled.tobytes()
+    row_size = shape[1]
+    with open(os.path.join(output_path, output_filename), 'wb',
+              buffering=max(image_2d_scaled.nbytes, io.DEFAULT_BUFFER_SIZE)) as png_file:
+        w = png.Writer(shape[1], shape[0], greyscale=True, bitdepth=8)
+        w.write(png_file, (image_bytes[i:i + row_size]
+                           for i in range(0, len(image_bytes), row_size)))
     
 
 def __get_tag_info(directory: Union[str, Path]) -> Dict[str, Any]:
-    filename = os.listdir(directory)[0]
-    dataset = pydicom.dcmread(os.path.join(directory, filename))
+    with os.scandir(directory) as entries:
+        filename = next(entry.name for entry in entries if entry.is_file())
+    # Only the catalogue tags are needed, so the pixel data is not read
+    dataset = read_dicom_header(os.path.join(directory, filename), specific_tags=list(_dicom_tags))
     
-    tags = {}
-    for tag_key in _dicom_tags:
-        try:
-            tags[tag_key] = dataset.data_element(tag_key).value
-        except:
-            tags[tag_key] = None
+    tags = {tag_key: dataset.get(tag_key, None) for tag_key in _dicom_tags}
         
     if tags['SpacingBetweenSlices'] is None:
         tags['SpacingBetweenSlices'] = tags['SliceThickness']
@@ -76,126 +93,176 @@ def __get_tag_info(directory: Union[str, Path]) -> Dict[str, Any]:
     return tags
     
     
+def __tag_info_fingerprint(entry_values: Dict) -> FrozenSet:
+    # Multi-valued tags (e.g. PixelSpacing) are lists, which are not hashable
+    return frozenset((key, tuple(value) if isinstance(value, (list, tuple)) else value)
+                     for key, value in entry_values.items())
+
+
 def __add_unique_tag_info(tag_dict: Dict[str, List[Dict]], entry_key: str,
-                          entry_values: Dict) -> None:
+                          entry_values: Dict, fingerprints: Dict[str, Set[FrozenSet]]) -> None:
+    # 'fingerprints' holds the hashed entries of 'tag_dict' per key, to check
+    # for duplicates without comparing against every stored entry
+    fingerprint = __tag_info_fingerprint(entry_values)
     
     if entry_key in tag_dict:
-        add_entry  = True
-        for value in tag_dict[entry_key]:
-            if entry_values == value:
-                add_entry = False
-                break
-        if add_entry:
+        if fingerprint not in fingerprints[entry_key]:
+            fingerprints[entry_key].add(fingerprint)
             tag_dict[entry_key].append(entry_values)
     else:
+        fingerprints[entry_key] = {fingerprint}
         tag_dict[entry_key] = [entry_values]
 
 
-def __expand_tags(entry_values: Dict) -> Dict:
-    expanded_values = {}
-
-    for tag_key in _dicom_tags:
-        if tag_key == 'MRAcquisitionType':
-            expanded_values[tag_key] = re.findall(r'\d+', entry_values[tag_key])[0]
-        elif tag_key == 'PixelSpacing':
-            new_key = tag_key + 'Row'
-            expanded_values[new_key] = entry_values[tag_key][0]
-            new_key = tag_key + 'Column'
-            expanded_values[new_key] = entry_values[tag_key][1]
-        elif tag_key == 'AcquisitionMatrix':
-            row = entry_values['AcquisitionMatrix'][0] if entry_values['AcquisitionMatrix'][0] != 0 else entry_values['AcquisitionMatrix'][2]
-            column = entry_values['AcquisitionMatrix'][1] if entry_values['AcquisitionMatrix'][1] != 0 else entry_values['AcquisitionMatrix'][3]
-            pixel_size_row = entry_values['Rows'] * entry_values['PixelSpacing'][0] / row
-            pixel_size_column = entry_values['Columns'] * entry_values['PixelSpacing'][1] / column
-            
-            expanded_values['PixelSizeRow'] = pixel_size_row            
-            expanded_values['PixelSizeColumn'] = pixel_size_column
-        elif tag_key == 'Rows' or tag_key == 'Columns':
-            continue
-        else:
-            expanded_values[tag_key] = entry_values[tag_key]
-        
-    return expanded_values
+def __pixel_sizes(entries: List[Dict]) -> Tuple[np.ndarray, np.ndarray]:
+    # Computes the acquired pixel size (row, column) of all the entries at once
+    acquisition_matrix = np.array([entry['AcquisitionMatrix'] for entry in entries],
+                                  dtype=float).reshape(-1, 4)
+    pixel_spacing = np.array([entry['PixelSpacing'] for entry in entries],
+                             dtype=float).reshape(-1, 2)
+    rows = np.array([entry['Rows'] for entry in entries], dtype=float)
+    columns = np.array([entry['Columns'] for entry in entries], dtype=float)
+    
+    # The acquisition matrix is either (frequency rows, 0, 0, phase columns)
+    # or (0, frequency columns, phase rows, 0)
+    matrix_rows = np.where(acquisition_matrix[:, 0] != 0, acquisition_matrix[:, 0],
+                           acquisition_matrix[:, 2])
+    matrix_columns = np.where(acquisition_matrix[:, 1] != 0, acquisition_matrix[:, 1],
+                              acquisition_matrix[:, 3])
+    
+    pixel_size_rows = rows * pixel_spacing[:, 0] / matrix_rows
+    pixel_size_columns = columns * pixel_spacing[:, 1] / matrix_columns
+    
+    return pixel_size_rows, pixel_size_columns
 
 
-def __add_tag_info(tag_dict: Dict[str, Dict[str, List]], entry_key: str,
-                   entry_values: Dict) -> None:
-    # Sequence: <tag key: List[values] >
+def __expand_tags_batch(entries: List[Dict]) -> List[Dict]:
+    pixel_size_rows, pixel_size_columns = __pixel_sizes(entries)
     
-    expanded_entry_values = __expand_tags(entry_values)
-    #print(tag_dict)
-    if entry_key in tag_dict:
-        for tag in tag_dict[entry_key]:
-            #print(expanded_entry_values[tag])
-            if expanded_entry_values[tag] is None:
+    expanded_entries = []
+    for entry_values, pixel_size_row, pixel_size_column in zip(entries, pixel_size_rows,
+                                                               pixel_size_columns):
+        expanded_values = {}
+    
+        for tag_key in _dicom_tags:
+            if tag_key == 'MRAcquisitionType':
+                expanded_values[tag_key] = _mr_acquisition_digits.search(entry_values[tag_key]).group()
+            elif tag_key == 'PixelSpacing':
+                new_key = tag_key + 'Row'
+                expanded_values[new_key] = entry_values[tag_key][0]
+                new_key = tag_key + 'Column'
+                expanded_values[new_key] = entry_values[tag_key][1]
+            elif tag_key == 'AcquisitionMatrix':
+                expanded_values['PixelSizeRow'] = float(pixel_size_row)
+                expanded_values['PixelSizeColumn'] = float(pixel_size_column)
+            elif tag_key == 'Rows' or tag_key == 'Columns':
                 continue
-            tag_dict[entry_key][tag].append(expanded_entry_values[tag])
-    else:
-        tag_dict[entry_key] = {}
-        for tag in expanded_entry_values:
-            if expanded_entry_values[tag] is None:
-                tag_dict[entry_key][tag] = []
             else:
-                tag_dict[entry_key][tag] = [expanded_entry_values[tag]]
+                expanded_values[tag_key] = entry_values[tag_key]
+                
+        expanded_entries.append(expanded_values)
+        
+    return expanded_entries
+
+
+def __expand_tags(entry_values: Dict) -> Dict:
+    return __expand_tags_batch([entry_values])[0]
+
+
+def __add_tag_info(tag_dict: DefaultDict[str, DefaultDict[str, List]], entry_key: str,
+                   entry_values: Dict) -> None:
+    # Sequence: <tag key: List[values] >
+    # 'tag_dict' is expected to be a defaultdict(lambda: defaultdict(list)).
+    # Every tag gets a (possibly empty) list, but only non-null values are added
+    sequence_tags = tag_dict[entry_key]
+    for tag, value in __expand_tags(entry_values).items():
+        tag_values = sequence_tags[tag]
+        if value is not None:
+            tag_values.append(value)
 
 
 def __tags_to_dataframe(tag_dict: Dict[str, List[Dict]]) -> pd.DataFrame:
-    columns = _dicom_tags.copy()
-    columns.insert(0, 'SequenceDescription')
-    columns.insert(1, 'Variant')
-    
-    df = pd.DataFrame(columns=columns) 
+    columns = ['SequenceDescription', 'Variant', *_dicom_tags]
     
+    # Collect the rows first and build the dataframe once, as appending to a
+    # dataframe copies it every time
+    rows = []
     for sequence, tags_info in tag_dict.items():
-        variant = 1
-        for tag_info in tags_info:
-            row = tag_info.copy()
-            row['SequenceDescription'] = sequence
-            row['Variant'] = variant
-            df = df.append(row, ignore_index=True)
-            variant += 1
+        for variant, tag_info in enumerate(tags_info, start=1):
+            rows.append({**tag_info, 'SequenceDescription': sequence, 'Variant': variant})
+            
+    df = pd.DataFrame(rows, columns=columns)
+    # The descriptions and acquisition types repeat across the rows
+    df = df.astype({'SequenceDescription': 'category', 'MRAcquisitionType': 'category'})
             
     return df
 
 
+def __save_figures(figures: Iterator[Tuple[str, Figure]], workers: int = 4) -> None:
+    # The figures are encoded to PNG on worker threads while the next ones are
+    # drawn, with at most 'workers' figures waiting to be saved at a time
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for file_path, fig in figures:
+            if len(pending) >= workers:
+                pending.popleft().result()
+            pending.append(executor.submit(fig.savefig, file_path, bbox_inches='tight'))
+            
+        for future in pending:
+            future.result()
+
+
 def __plot_histograms(tag_dict: Dict[str, Dict[str, List]], group: str) -> None:
     path = 'catalogue_output/histograms/' + group
     os.makedirs(path, exist_ok=True)
+    __save_figures(__histogram_figures(tag_dict, path + os.sep))
+    
     
+def __histogram_figures(tag_dict: Dict[str, Dict[str, List]],
+                        path_prefix: str) -> Iterator[Tuple[str, Figure]]:
     for sequence in tag_dict:
-        fig = plt.figure(figsize=(10, 20))
-        plot_index = 1
+        fig = Figure(figsize=(10, 20))
+        FigureCanvasAgg(fig)
+        axes = fig.subplots(5, 3).ravel()
         
-        for tag in tag_dict[sequence]:
-            plt.subplot(5, 3, plot_index)
-            plt.hist(tag_dict[sequence][tag], bins=10)
-            plt.title(tag)
+        for plot_index, tag in enumerate(tag_dict[sequence]):
+            # Bin with numpy and only draw the bars
+            counts, edges = np.histogram(np.asarray(tag_dict[sequence][tag], dtype=float), bins=10)
+            axes[plot_index].bar(edges[:-1], counts, width=np.diff(edges), align='edge')
+            axes[plot_index].set_title(tag)
             
-            plot_index += 1
+        # Hide the unused grid cells
+        for ax in axes[len(tag_dict[sequence]):]:
+            ax.axis('off')
 
-        plt.suptitle(sequence, fontsize=20)
-        fig.savefig(os.path.join(path, sequence + '.png'), bbox_inches='tight')
-        plt.close(fig)
+        fig.suptitle(sequence, fontsize=20)
+        yield path_prefix + sequence + '.png', fig
 
 
 def __plot_scatter_plots(tag_dict: Dict[str, Dict[str, List]], group: str) -> None:
     path = 'catalogue_output/scatter_plots/' + group
     os.makedirs(path, exist_ok=True)
+    __save_figures(__scatter_figures(tag_dict, path + os.sep))
     
+    
+def __scatter_figures(tag_dict: Dict[str, Dict[str, List]],
+                      path_prefix: str) -> Iterator[Tuple[str, Figure]]:
     for sequence in tag_dict:
-        fig = plt.figure()
+        fig = Figure(dpi=100)
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
         
-        plt.title('Repetition/Echo Time - ' + sequence)
-        plt.scatter(tag_dict[sequence]['RepetitionTime'], tag_dict[sequence]['EchoTime'])
-        plt.xlabel('Repetition Time (ms)')
-        plt.ylabel('Echo Time (ms)')
-        plt.grid()
+        ax.set_title('Repetition/Echo Time - ' + sequence)
+        ax.scatter(tag_dict[sequence]['RepetitionTime'], tag_dict[sequence]['EchoTime'],
+                   s=4, rasterized=True)
+        ax.set_xlabel('Repetition Time (ms)')
+        ax.set_ylabel('Echo Time (ms)')
+        ax.grid()
         
-        fig.savefig(os.path.join(path, sequence + '.png'), bbox_inches='tight')
-        plt.close(fig)
+        yield path_prefix + sequence + '.png', fig
     
         
-def overview(directory: Union[str, Path]) -> None:
+def overview(directory: Union[str, Path], progress: bool = True) -> None:
     current_sequence = None
     categories = Categories()
     metadata_split = MetadataSplit()
@@ -204,15 +271,32 @@ def overview(directory: Union[str, Path]) -> None:
     
     data_count = {}
     
+    # Collect all the series folders first, together with the names in each
+    # patient folder, before any of them is renamed
+    patient_series = []
+    with os.scandir(directory) as patient_entries:
+        for patient_entry in patient_entries:
+            if not patient_entry.is_dir():
+                continue
+            if progress:
+                print('Reading patient folder: ' + patient_entry.name)
+            with os.scandir(patient_entry.path) as series_entries:
+                series_entries = list(series_entries)
+            patient_series.append((patient_entry.path,
+                                   [(entry.name, entry.path) for entry in series_entries
+                                    if entry.is_dir()],
+                                   {entry.name for entry in series_entries}))
+    
     # Per patient
-    for folder_name in next(os.walk(directory))[1]:
-        print('Reading patient folder: ' + folder_name)
+    for patient_path, subfolders, existing_names in patient_series:
         cine_sequences = []
         multi_sequences = []
+        # Next free duplicate suffix per folder name
+        duplicate_counters = {}
         # Per sequence
         
         already_added_for_patient = {}
-        for subfolder_name in next(os.walk(os.path.join(directory, folder_name)))[1]:
+        for subfolder_name, subfolder_path in subfolders:
             # Folder naming is expected to have the format: Series<number>_<series_description>
             series, sequence = subfolder_name.split('_', 1)
             #if sequence == current_sequence:
@@ -223,15 +307,16 @@ def overview(directory: Union[str, Path]) -> None:
             sequence_mapping = Categories.get_label(sequence)
             categories.store_sequence_mapping(sequence, sequence_mapping['type'], sequence_mapping['anatomy'])
             
-            #metadata = metadata_split.get_tag_info(os.path.join(directory, folder_name, subfolder_name))
+            #metadata = metadata_split.get_tag_info(subfolder_path)
             #_ = metadata_split.get_split_id(sequence_mapping['type'], sequence_mapping['anatomy'], metadata)
-            print(sequence_mapping)
+            if progress:
+                print(sequence_mapping)
             if sequence_mapping['anatomy']:
                 new_folder_name = series + '_' + sequence_mapping['type'] + '_' + sequence_mapping['anatomy']
             else:
                 new_folder_name = series + '_' + sequence_mapping['type'] + '_Other'
                 
-            if Categories.is_repeat(sequence):
+            if _is_repeat_cached(sequence):
                 new_folder_name += '_repeat'
                 continue
             
@@ -246,23 +331,25 @@ def overview(directory: Union[str, Path]) -> None:
                 data_count[new_folder_name] += 1
             else:
                 data_count[new_folder_name] = 1
- 
-            try:
-                os.rename(os.path.join(directory, folder_name, subfolder_name),
-                          os.path.join(directory, folder_name, new_folder_name))
-            except FileExistsError:
-                while True:
-                    duplicate_index = 1
-                    new_folder_name_duplicate = new_folder_name + '_' + str(duplicate_index)
-                    
-                    try:
-                        os.rename(os.path.join(directory, folder_name, subfolder_name),
-                                  os.path.join(directory, folder_name, new_folder_name_duplicate))
-                    except FileExistsError:
-                        duplicate_index += 1
-                        continue
-                    
-                    break
+
+            if new_folder_name == subfolder_name:
+                # Already catalogued (e.g. by a previous execution)
+                continue
+
+            # The names in the patient folder are tracked in memory, so a free
+            # name is found without checking the file system. The folder's own
+            # name is not a clash.
+            existing_names.discard(subfolder_name)
+            if new_folder_name in existing_names:
+                # Continue from the last suffix used for this folder name
+                duplicate_index = duplicate_counters.get(new_folder_name, 1)
+                while new_folder_name + '_' + str(duplicate_index) in existing_names:
+                    duplicate_index += 1
+                duplicate_counters[new_folder_name] = duplicate_index + 1
+                new_folder_name = new_folder_name + '_' + str(duplicate_index)
+                
+            os.rename(subfolder_path, os.path.join(patient_path, new_folder_name))
+            existing_names.add(new_folder_name)
 
             
     
\ No newline at end of file
@@ -1,22 +1,109 @@
 import os
 import re
 
-from typing import Dict, List, Union
+from typing import Dict, List, Pattern, Tuple, Union
 from pathlib import Path
-from itertools import combinations
+from collections import Counter
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 
 
+# The label patterns are compiled once and match regardless of case
+_MIP_RE = re.compile(r'mip|m\.i\.p', re.IGNORECASE)
+_MPR_RE = re.compile(r'mpr', re.IGNORECASE)
+_PERFUSION_RE = re.compile(r'perf', re.IGNORECASE)
+_QFLOW_RE = re.compile(r'flow', re.IGNORECASE)
+_ANGIO_RE = re.compile(r'angio', re.IGNORECASE)
+_SCOUT_RE = re.compile(r'scout', re.IGNORECASE)
+_BB_RE = re.compile(r'bb', re.IGNORECASE)
+_DB_RE = re.compile(r'db', re.IGNORECASE)
+_T1W_RE = re.compile(r'(?=.*t1)^((?!map).)*$', re.IGNORECASE)
+_T2W_RE = re.compile(r'(?=.*t2)^((?!map).)*$', re.IGNORECASE)
+_T1_RE = re.compile(r't1.*map', re.IGNORECASE)
+_T2_RE = re.compile(r't2.*map', re.IGNORECASE)
+_CINE_RE = re.compile(r'cine', re.IGNORECASE)
+_LATE_GAD_RE = re.compile(r'lg|late.*g[a]?d', re.IGNORECASE)
+_EARLY_GAD_RE = re.compile(r'^eg|eg_|_eg|early.*g[a]?d', re.IGNORECASE)
+_PRE_MOLLI_RE = re.compile(r'pre.*molli', re.IGNORECASE)
+_POST_MOLLI_RE = re.compile(r'post.*molli', re.IGNORECASE)
+_TWO_CHAMBER_RE = re.compile(r'2ch', re.IGNORECASE)
+_THREE_CHAMBER_RE = re.compile(r'3ch|lvot', re.IGNORECASE)
+_FOUR_CHAMBER_RE = re.compile(r'4ch', re.IGNORECASE)
+_LVSA_RE = re.compile(r'lvsa|sax', re.IGNORECASE)
+_RVOT_RE = re.compile(r'rvot', re.IGNORECASE)
+_MV_RE = re.compile(r'mv', re.IGNORECASE)
+_RV_RE = re.compile(r'(?=.*rv)^((?!rvot).)*$', re.IGNORECASE)
+_REPEAT_RE = re.compile(r' 2$|repeat$|repetition', re.IGNORECASE)
+
+# Type labels in the order they take priority: (group name, pattern, label,
+# whether the anatomy is also labelled)
+_TYPE_LABELS = (('mip', _MIP_RE, 'MIP_merged', False),
+                ('mpr', _MPR_RE, 'MPR_merged', False),
+                ('perfusion', _PERFUSION_RE, 'Perf_merged', False),
+                ('qflow', _QFLOW_RE, 'Qflow_merged', False),
+                ('angio', _ANGIO_RE, 'Angio_merged', False),
+                ('scout', _SCOUT_RE, 'Scout_merged', False),
+                ('bb', _BB_RE, 'BB_merged', False),
+                ('db', _DB_RE, 'DB_merged', False),
+                ('t1w', _T1W_RE, 'T1w_merged', False),
+                ('t2w', _T2W_RE, 'T2w_merged', False),
+                ('t1', _T1_RE, 'T1_Map', True),
+                ('t2', _T2_RE, 'T2_Map', True),
+                ('cine', _CINE_RE, 'CINE', True),
+                ('late_gad', _LATE_GAD_RE, 'Late_Gad', True),
+                ('early_gad', _EARLY_GAD_RE, 'Early_Gad', True),
+                ('pre_molli', _PRE_MOLLI_RE, 'T1_Map', True),
+                ('post_molli', _POST_MOLLI_RE, 'T1_Map', True))
+_TYPE_LABEL_GROUPS = {name: (label, with_anatomy) for name, _, label, with_anatomy in _TYPE_LABELS}
+
+# The image types and anatomies that are grouped per patient, as '<type>_<anatomy>'
+# tokens. Each (type, anatomy) pair has a bit, assigned in sorted token order
+_GROUPING_TYPES = ('CINE', 'Late_Gad', 'Early_Gad', 'T1_Map', 'T2_Map')
+_GROUPING_ANATOMIES = ('2ch', 'LVOT', '4ch', 'LVSA', 'RVOT', 'MV', 'RV')
+_TOKEN_NAMES = tuple(sorted(image_type + '_' + anatomy for image_type in _GROUPING_TYPES
+                            for anatomy in _GROUPING_ANATOMIES))
+_TOKEN_BIT = {(image_type, anatomy): _TOKEN_NAMES.index(image_type + '_' + anatomy)
+              for image_type in _GROUPING_TYPES for anatomy in _GROUPING_ANATOMIES}
+
+
+def _priority_regex(labels: Tuple[Tuple, ...]) -> Pattern:
+    # Combines the (group name, pattern, ...) labels into a single regex. Each
+    # alternative is a lookahead from the start of the description (equivalent
+    # to searching for its pattern) followed by an empty named group, so the
+    # first alternative in priority order that matches anywhere wins, instead
+    # of the leftmost match in the string
+    return re.compile('^(?:' + '|'.join(r'(?=[\s\S]*?(?:{}))(?P<{}>)'.format(label[1].pattern, label[0])
+                                        for label in labels) + ')',
+                      re.IGNORECASE)
+
+
+_TYPE_RE = _priority_regex(_TYPE_LABELS)
+
+# Anatomy labels in the order they take priority: (group name, pattern, label)
+_ANATOMY_LABELS = (('two_chamber', _TWO_CHAMBER_RE, '2ch'),
+                   ('three_chamber', _THREE_CHAMBER_RE, 'LVOT'),
+                   ('four_chamber', _FOUR_CHAMBER_RE, '4ch'),
+                   ('lvsa', _LVSA_RE, 'LVSA'),
+                   ('rvot', _RVOT_RE, 'RVOT'),
+                   ('mv', _MV_RE, 'MV'),
+                   ('rv', _RV_RE, 'RV'))
+_ANATOMY_LABEL_GROUPS = {name: label for name, _, label in _ANATOMY_LABELS}
+_ANATOMY_RE = _priority_regex(_ANATOMY_LABELS)
+
+
 class Categories():
+    # The label methods expect an already lowercase sequence description, so
+    # the caller lowercases it once. The labels matched by plain substrings are
+    # tested with 'in', the others with their regex
     class TypeLabels():
         
         @staticmethod
         def mip(sequence_description: str) -> Union[None, str]:
-            regex_string = 'mip|m\.i\.p'
-            if re.findall(regex_string, sequence_description.lower()):
+            if 'mip' in sequence_description or 'm.i.p' in sequence_description:
                 return 'MIP_merged'
             
             return None
@@ -24,8 +111,7 @@ class Categories():
         
         @staticmethod
         def mpr(sequence_description: str) -> Union[None, str]:
-            regex_string = 'mpr'
-            if re.findall(regex_string, sequence_description.lower()):
+            if 'mpr' in sequence_description:
                 return 'MPR_merged'
             
             return None
@@ -33,8 +119,7 @@ class Categories():
         
         @staticmethod
         def perfusion(sequence_description: str) -> Union[None, str]:
-            regex_string = 'perf'
-            if re.findall(regex_string, sequence_description.lower()):
+            if 'perf' in sequence_description:
                 return 'Perf_merged'
             
             return None
@@ -42,8 +127,7 @@ class Categories():
         
         @staticmethod
         def qflow(sequence_description: str) -> Union[None, str]:
-            regex_string = 'flow'
-            if re.findall(regex_string, sequence_description.lower()):
+            if 'flow' in sequence_description:
                 return 'Qflow_merged'
             
             return None
@@ -51,8 +135,7 @@ class Categories():
         
         @staticmethod
         def angio(sequence_description: str) -> Union[None, str]:
-            regex_string = 'angio'
-            if re.findall(regex_string, sequence_description.lower()):
+            if 'angio' in sequence_description:
                 return 'Angio_merged'
             
             return None
@@ -60,8 +143,7 @@ class Categories():
 
         @staticmethod
         def scout(sequence_description: str) -> Union[None, str]:
-            regex_string = 'scout'
-            if re.findall(regex_string, sequence_description.lower()):
+            if 'scout' in sequence_description:
                 return 'Scout_merged'
             
             return None
@@ -69,8 +151,7 @@ class Categories():
     
         @staticmethod
         def bb(sequence_description: str) -> Union[None, str]:
-            regex_string = 'bb'
-            if re.findall(regex_string, sequence_description.lower()):
+            if 'bb' in sequence_description:
                 return 'BB_merged'
             
             return None
@@ -78,8 +159,7 @@ class Categories():
         
         @staticmethod
         def db(sequence_description: str) -> Union[None, str]:
-            regex_string = 'db'
-            if re.findall(regex_string, sequence_description.lower()):
+            if 'db' in sequence_description:
                 return 'DB_merged'
             
             return None
@@ -87,8 +167,7 @@ class Categories():
         
         @staticmethod
         def t1w(sequence_description: str) -> Union[None, str]:
-            regex_string = '(?=.*t1)^((?!map).)*$'
-            if re.findall(regex_string, sequence_description.lower()):
+            if _T1W_RE.search(sequence_description) is not None:
                 return 'T1w_merged'
             
             return None
@@ -96,8 +175,7 @@ class Categories():
         
         @staticmethod
         def t2w(sequence_description: str) -> Union[None, str]:
-            regex_string = '(?=.*t2)^((?!map).)*$'
-            if re.findall(regex_string, sequence_description.lower()):
+            if _T2W_RE.search(sequence_description) is not None:
                 return 'T2w_merged'
             
             return None
@@ -105,8 +183,7 @@ class Categories():
 
         @staticmethod
         def t1(sequence_description: str) -> Union[None, str]:
-            regex_string = 't1.*map'
-            if re.findall(regex_string, sequence_description.lower()):
+            if _T1_RE.search(sequence_description) is not None:
                 return 'T1_Map'
             
             return None
@@ -114,8 +191,7 @@ class Categories():
         
         @staticmethod
         def t2(sequence_description: str) -> Union[None, str]:
-            regex_string = 't2.*map'
-            if re.findall(regex_string, sequence_description.lower()):
+            if _T2_RE.search(sequence_description) is not None:
                 return 'T2_Map'
             
             return None
@@ -123,8 +199,7 @@ class Categories():
         
         @staticmethod
         def cine(sequence_description: str) -> Union[None, str]:
-            regex_string = 'cine'
-            if re.findall(regex_string, sequence_description.lower()):
+            if 'cine' in sequence_description:
                 return 'CINE'
             
             return None
@@ -132,8 +207,7 @@ class Categories():
 
         @staticmethod
         def late_gad(sequence_description: str) -> Union[None, str]:
-            regex_string = 'lg|late.*g[a]?d'
-            if re.findall(regex_string, sequence_description.lower()):
+            if _LATE_GAD_RE.search(sequence_description) is not None:
                 return 'Late_Gad'
             
             return None
@@ -141,8 +215,7 @@ class Categories():
         
         @staticmethod
         def early_gad(sequence_description: str) -> Union[None, str]:
-            regex_string = '^eg|eg_|_eg|early.*g[a]?d'
-            if re.findall(regex_string, sequence_description.lower()):
+            if _EARLY_GAD_RE.search(sequence_description) is not None:
                 return 'Early_Gad'
             
             return None
@@ -150,8 +223,7 @@ class Categories():
 
         @staticmethod
         def pre_molli(sequence_description: str) -> Union[None, str]:
-            regex_string = 'pre.*molli'
-            if re.findall(regex_string, sequence_description.lower()):
+            if _PRE_MOLLI_RE.search(sequence_description) is not None:
                 return 'T1_Map' #'Pre_MOLLI'
             
             return None
@@ -160,8 +232,7 @@ class Categories():
         
         @staticmethod
         def post_molli(sequence_description: str) -> Union[None, str]:
-            regex_string = 'post.*molli'
-            if re.findall(regex_string, sequence_description.lower()):
+            if _POST_MOLLI_RE.search(sequence_description) is not None:
                 return 'T1_Map' #'Post_MOLLI'
             
             return None
@@ -171,8 +242,7 @@ class Categories():
         
         @staticmethod
         def two_chamber(sequence_description: str) -> Union[None, str]:
-            regex_string = '2ch'
-            if re.findall(regex_string, sequence_description.lower()):
+            if '2ch' in sequence_description:
                 return '2ch'
             
             return None
@@ -180,8 +250,7 @@ class Categories():
 
         @staticmethod
         def three_chamber(sequence_description: str) -> Union[None, str]:
-            regex_string = '3ch|lvot'
-            if re.findall(regex_string, sequence_description.lower()):
+            if '3ch' in sequence_description or 'lvot' in sequence_description:
                 return 'LVOT'
             
             return None
@@ -189,8 +258,7 @@ class Categories():
 
         @staticmethod
         def four_chamber(sequence_description: str) -> Union[None, str]:
-            regex_string = '4ch'
-            if re.findall(regex_string, sequence_description.lower()):
+            if '4ch' in sequence_description:
                 return '4ch'
             
             return None
@@ -198,8 +266,7 @@ class Categories():
 
         @staticmethod
         def lvsa(sequence_description: str) -> Union[None, str]:
-            regex_string = 'lvsa|sax'
-            if re.findall(regex_string, sequence_description.lower()):
+            if 'lvsa' in sequence_description or 'sax' in sequence_description:
                 return 'LVSA'
             
             return None
@@ -207,8 +274,7 @@ class Categories():
 
         @staticmethod
         def rvot(sequence_description: str) -> Union[None, str]:
-            regex_string = 'rvot'
-            if re.findall(regex_string, sequence_description.lower()):
+            if 'rvot' in sequence_description:
                 return 'RVOT'
             
             return None
@@ -216,8 +282,7 @@ class Categories():
         
         @staticmethod
         def mv(sequence_description: str) -> Union[None, str]:
-            regex_string = 'mv'
-            if re.findall(regex_string, sequence_description.lower()):
+            if 'mv' in sequence_description:
                 return 'MV'
             
             return None
@@ -225,22 +290,19 @@ class Categories():
         
         @staticmethod
         def rv(sequence_description: str) -> Union[None, str]:
-            regex_string = '(?=.*rv)^((?!rvot).)*$'
-            if re.findall(regex_string, sequence_description.lower()):
+            if _RV_RE.search(sequence_description) is not None:
                 return 'RV'
             
             return None
         
         
     def __init__(self) -> None:
-        self.sequence_mapping = {}
+        # Sequence description: (type label, anatomy label) and its count
+        self.sequence_labels = {}
+        self.sequence_counts = Counter()
         
-        self.anatomy_matches = ['2ch', '4ch', 'LVOT', 'LVSA', 'RVOT', 'RV', 'MV']
-        self.anatomy_combinations = []
-        for i in range(1, len(self.anatomy_matches) + 1):
-            combination_list = list(map(list, combinations(self.anatomy_matches, i)))
-            #combination_list.sort()
-            self.anatomy_combinations.append(combination_list)
+        # Immutable, as the anatomy labels are only iterated over
+        self.anatomy_matches = ('2ch', '4ch', 'LVOT', 'LVSA', 'RVOT', 'RV', 'MV')
         
         self.cine_grouping = {}
         
@@ -262,115 +324,48 @@ class Categories():
             Returns True if the passed sequence is possibly a repeat scan.
 
         """
-        regex_string = ' 2$|repeat$|repetition'
-        if re.findall(regex_string, sequence_description.lower()):
-            return True
-        
-        return False
+        return _REPEAT_RE.search(sequence_description) is not None
         
     
     @staticmethod
     def get_label(sequence_description: str) -> Dict[str, Union[None, str]]:        
-        def get_anatomy_label(sequence_description: str) -> Union[None, str]:
-            a_label = Categories.AnatomyLabels.two_chamber(sequence_description)
-            if a_label is not None:
-                return a_label
-            
-            a_label = Categories.AnatomyLabels.three_chamber(sequence_description)
-            if a_label is not None:
-                return a_label
-            
-            a_label = Categories.AnatomyLabels.four_chamber(sequence_description)
-            if a_label is not None:
-                return a_label
-            
-            a_label = Categories.AnatomyLabels.lvsa(sequence_description)
-            if a_label is not None:
-                return a_label
-            
-            a_label = Categories.AnatomyLabels.rvot(sequence_description)
-            if a_label is not None:
-                return a_label
-            
-            a_label = Categories.AnatomyLabels.mv(sequence_description)
-            if a_label is not None:
-                return a_label
-            
-            a_label = Categories.AnatomyLabels.rv(sequence_description)
-            if a_label is not None:
-                return a_label
-            
-            return None
-            
-        label = Categories.TypeLabels.mip(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': None}
-        
-        label = Categories.TypeLabels.mpr(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': None}
-        
-        label = Categories.TypeLabels.perfusion(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': None}
-        
-        label = Categories.TypeLabels.qflow(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': None}
+        # The classification is cached per (lowercase) sequence description
+        type_label, anatomy_label = _classify(sequence_description.lower())
         
-        label = Categories.TypeLabels.angio(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': None}
-        
-        label = Categories.TypeLabels.scout(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': None}
-        
-        label = Categories.TypeLabels.bb(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': None}
-        
-        label = Categories.TypeLabels.db(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': None}
-        
-        label = Categories.TypeLabels.t1w(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': None}
-        
-        label = Categories.TypeLabels.t2w(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': None}
-        
-        label = Categories.TypeLabels.t1(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': get_anatomy_label(sequence_description)}
-        
-        label = Categories.TypeLabels.t2(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': get_anatomy_label(sequence_description)}
-        
-        label = Categories.TypeLabels.cine(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': get_anatomy_label(sequence_description)}
-        
-        label = Categories.TypeLabels.late_gad(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': get_anatomy_label(sequence_description)}
-        
-        label = Categories.TypeLabels.early_gad(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': get_anatomy_label(sequence_description)}
-        
-        label = Categories.TypeLabels.pre_molli(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': get_anatomy_label(sequence_description)}
+        return {'type': type_label, 'anatomy': anatomy_label}
+    
+    
+    @staticmethod
+    def classify_series(sequence_descriptions: pd.Series) -> pd.DataFrame:
+        """
+        Labels a series of sequence descriptions, as get_label() does for a
+        single description. Each distinct description is classified once.
+        Missing descriptions are labelled as empty descriptions ('Other').
+
+        Parameters
+        ----------
+        sequence_descriptions : pd.Series
+            The original sequence descriptions.
+
+        Returns
+        -------
+        pd.DataFrame
+            The 'type' and 'anatomy' labels of each description, with the same
+            index as the passed series. As with get_label(), a missing anatomy
+            label is None.
+
+        """
+        lower_descriptions = sequence_descriptions.fillna('').astype(str).str.lower()
+        unique_descriptions = pd.unique(lower_descriptions)
+        labels = pd.DataFrame([_classify(description) for description in unique_descriptions],
+                              index=unique_descriptions, columns=['type', 'anatomy'], dtype=object)
         
-        label = Categories.TypeLabels.post_molli(sequence_description)
-        if label is not None:
-            return {'type': label, 'anatomy': get_anatomy_label(sequence_description)}
+        labels = labels.loc[lower_descriptions]
+        labels.index = sequence_descriptions.index
+        # Missing anatomy labels may be turned into NaN by pandas
+        labels = labels.where(labels.notna(), None)
         
-        return {'type': 'Other', 'anatomy': None}
+        return labels
     
     
     def store_sequence_mapping(self, sequence: str, type_label: str,
@@ -394,32 +389,39 @@ class Categories():
 
         """
         
-        if sequence in self.sequence_mapping:
-            self.sequence_mapping[sequence][2] += 1
-        else:
-            self.sequence_mapping[sequence] = [type_label, anatomy_label, 1]
+        self.sequence_counts[sequence] += 1
+        self.sequence_labels.setdefault(sequence, (type_label, anatomy_label))
     
     
     def visualise_sequence_mapping(self, output_path: Union[str, Path]) -> None:
         # Build the DataFrame structure to pass to the plotly function
-        sequence = []
-        image_type = []
-        image_anatomy = []
-        count = []
-        
-        for sequence_key, list_label in self.sequence_mapping.items():
-            sequence.append(sequence_key)
-            image_type.append(list_label[0])
-            image_anatomy.append(list_label[1] if list_label[1] else 'N/A')
-            count.append(list_label[2])
-            
-        df = pd.DataFrame(dict(sequence=sequence, image_type=image_type,
-                               image_anatomy=image_anatomy, count=count))  
-        
-        df['all'] = 'All'
-        fig = px.treemap(df, path=['all', 'image_type', 'image_anatomy', 'sequence'],
-                         values='count', title='Sequence Grouping')
-        fig.update_layout(uniformtext=dict(minsize=16, mode='hide'))
+        df = pd.DataFrame.from_dict(self.sequence_labels, orient='index',
+                                    columns=['image_type', 'image_anatomy'])
+        df = df.rename_axis('sequence').reset_index()
+        df['image_anatomy'] = df['image_anatomy'].fillna('N/A')
+        df['count'] = df['sequence'].map(self.sequence_counts)
+        
+        # Build the treemap hierarchy (All > type > anatomy > sequence) directly,
+        # each level summing the counts of its children
+        types = df.groupby('image_type', sort=False)['count'].sum().reset_index()
+        types_id = 'All/' + types['image_type']
+        anatomies = df.groupby(['image_type', 'image_anatomy'], sort=False)['count'].sum().reset_index()
+        anatomies_parent = 'All/' + anatomies['image_type']
+        anatomies_id = anatomies_parent + '/' + anatomies['image_anatomy']
+        sequences_parent = 'All/' + df['image_type'] + '/' + df['image_anatomy']
+        sequences_id = sequences_parent + '/' + df['sequence']
+        
+        ids = pd.concat([pd.Series(['All']), types_id, anatomies_id, sequences_id], ignore_index=True)
+        labels = pd.concat([pd.Series(['All']), types['image_type'], anatomies['image_anatomy'],
+                            df['sequence']], ignore_index=True)
+        parents = pd.concat([pd.Series(['']), pd.Series('All', index=types.index), anatomies_parent,
+                             sequences_parent], ignore_index=True)
+        values = pd.concat([pd.Series([df['count'].sum()]), types['count'], anatomies['count'],
+                            df['count']], ignore_index=True)
+        
+        fig = go.Figure(go.Treemap(ids=ids, labels=labels, parents=parents, values=values,
+                                   branchvalues='total'))
+        fig.update_layout(title='Sequence Grouping', uniformtext=dict(minsize=16, mode='hide'))
         
         if output_path is None:
             output_path = Path('.')
@@ -429,10 +431,7 @@ class Categories():
 
     @staticmethod
     def __list_to_string(anatomy_list: List[str]) -> str:
-        tmp_list = anatomy_list.copy()
-        tmp_list.sort()
-        anatomy_string = '+'.join(tmp_list)
-        return anatomy_string
+        return '+'.join(sorted(anatomy_list))
 
 
     """
@@ -512,27 +511,17 @@ class Categories():
         """
                         
                 
-        cine_anatomy_list = []
+        # The grouped (type, anatomy) labels of the patient as a bitmask
+        cine_mask = 0
         for cine in patient_cine:
-            if cine['anatomy'] is None:
-                continue
-            
-            if cine['type'] == 'CINE':
-                cine_anatomy_list.append('CINE_' + cine['anatomy'])
-            elif cine['type'] == 'Late_Gad':
-                cine_anatomy_list.append('Late_Gad_' + cine['anatomy'])
-            elif cine['type'] == 'Early_Gad':
-                cine_anatomy_list.append('Early_Gad_' + cine['anatomy'])
-            elif cine['type'] == 'T1_Map':
-                cine_anatomy_list.append('T1_Map_' + cine['anatomy'])
-            elif cine['type'] == 'T2_Map':
-                cine_anatomy_list.append('T2_Map_' + cine['anatomy'])
+            bit = _TOKEN_BIT.get((cine['type'], cine['anatomy']))
+            if bit is not None:
+                cine_mask |= 1 << bit
                 
-        #print(cine_anatomy_list)
-        if len(cine_anatomy_list) == 0:
+        if cine_mask == 0:
             return
         
-        cine_key = Categories.__list_to_string(list(set(cine_anatomy_list)))
+        cine_key = _mask_key(cine_mask)
         if cine_key in self.cine_grouping:
             self.cine_grouping[cine_key].append(patient_id)
         else:
@@ -540,16 +529,9 @@ class Categories():
             
             
     def visualise_cine_grouping(self, output_path: Union[str, Path]) -> None:
-        cine_count = []
-        for cine_key, patient_list in self.cine_grouping.items():
-            if len(patient_list) != 0:
-                cine_count.append([cine_key, len(patient_list)])
-            
-        cine_prune = []
-        for i in range(len(cine_count)):
-            if cine_count[i][1] >= 20:
-                cine_prune.append(cine_count[i])
-        df = pd.DataFrame(cine_prune, columns = ['Image/Anatomy Combinations', 'Count'])
+        cine_count = pd.Series({cine_key: len(patient_list) for cine_key, patient_list in self.cine_grouping.items()},
+                               dtype='int64')
+        df = cine_count[cine_count >= 20].rename_axis('Image/Anatomy Combinations').reset_index(name='Count')
         
         fig = px.bar(df, y='Count', x='Image/Anatomy Combinations', text='Count')
         fig.update_traces(texttemplate='%{text:.2s}', textposition='outside')
@@ -559,35 +541,79 @@ class Categories():
             output_path = Path('.')
         os.makedirs(output_path, exist_ok=True)
         
-        df.to_csv(os.path.join(output_path, 'grouping.csv'))
-        fig.write_html(os.path.join(output_path, 'grouping.html'))
+        # The files are written on worker threads while the next plot is built
+        io_pool = ThreadPoolExecutor(max_workers=2)
+        futures = [io_pool.submit(df.to_csv, os.path.join(output_path, 'grouping.csv')),
+                   io_pool.submit(fig.write_html, os.path.join(output_path, 'grouping.html'))]
             
         
         ## Visualise cumulative count
-        cine_count = []
-        for cine_key, patient_list in self.cine_grouping.items():
-                cine_count.append([cine_key, len(patient_list)])
-                
-        for cine_key, patient_list in self.cine_grouping.items():
-            cine_key_list = cine_key.split('+')
-            for i in range(1, len(cine_key_list)):
-                combination_list = list(map(list, combinations(cine_key_list, i)))
-                for individual_combination in combination_list:
-                    new_cine_key = Categories.__list_to_string(individual_combination)
-                    for j in cine_count:
-                        if j[0] == new_cine_key:
-                            j[1] += len(patient_list)
-                            break
-                
-        cine_prune = []
-        for i in range(len(cine_count)):
-            if cine_count[i][1] >= 20:
-                cine_prune.append(cine_count[i])
-        df = pd.DataFrame(cine_prune, columns = ['Image/Anatomy Combinations (subset inclusive)', 'Count'])
+        cine_count = pd.Series(_subset_inclusive_counts({cine_key: len(patient_list)
+                                                         for cine_key, patient_list in self.cine_grouping.items()}),
+                               dtype='int64')
+        df = cine_count[cine_count >= 20].rename_axis('Image/Anatomy Combinations (subset inclusive)').reset_index(name='Count')
         
         fig = px.bar(df, y='Count', x='Image/Anatomy Combinations (subset inclusive)', text='Count')
         fig.update_traces(texttemplate='%{text:.2s}', textposition='outside')
         fig.update_layout(xaxis_tickangle=0)
         
-        df.to_csv(os.path.join(output_path, 'grouping_subset.csv'))
-        fig.write_html(os.path.join(output_path, 'grouping_subset.html'))
+        futures += [io_pool.submit(df.to_csv, os.path.join(output_path, 'grouping_subset.csv')),
+                    io_pool.submit(fig.write_html, os.path.join(output_path, 'grouping_subset.html'))]
+        
+        io_pool.shutdown(wait=True)
+        for future in futures:
+            future.result()
+
+
+@lru_cache(maxsize=65536)
+def _classify(sequence_description: str) -> Tuple[str, Union[None, str]]:
+    # Returns the (type, anatomy) labels of a lowercase sequence description
+    def get_anatomy_label(sequence_description: str) -> Union[None, str]:
+        match = _ANATOMY_RE.match(sequence_description)
+        if match is None:
+            return None
+        
+        return _ANATOMY_LABEL_GROUPS[match.lastgroup]
+        
+    match = _TYPE_RE.match(sequence_description)
+    if match is None:
+        return 'Other', None
+    
+    label, with_anatomy = _TYPE_LABEL_GROUPS[match.lastgroup]
+    if with_anatomy:
+        return label, get_anatomy_label(sequence_description)
+    
+    return label, None
+
+
+@lru_cache(maxsize=4096)
+def _mask_key(mask: int) -> str:
+    # The token bits follow the sorted token names, so the names decoded from
+    # the lowest bit up are already in the sorted key order
+    return '+'.join(name for bit, name in enumerate(_TOKEN_NAMES) if mask >> bit & 1)
+
+
+def _subset_inclusive_counts(combination_counts: Dict[str, int]) -> Dict[str, int]:
+    # Adds the count of each combination to the observed combinations that are
+    # a proper subset of it. The combinations are encoded as bitmasks (one bit
+    # per label), so the subsets are enumerated with the submask recurrence
+    # sub = (sub - 1) & mask instead of building every label combination
+    token_bits = {}
+    masks = {}
+    for combination in combination_counts:
+        mask = 0
+        for token in combination.split('+'):
+            mask |= token_bits.setdefault(token, 1 << len(token_bits))
+        masks[combination] = mask
+        
+    mask_counts = {masks[combination]: count for combination, count in combination_counts.items()}
+    subset_counts = dict(mask_counts)
+    for mask, count in mask_counts.items():
+        submask = (mask - 1) & mask
+        while submask:
+            # Only the combinations that were observed are counted
+            if submask in subset_counts:
+                subset_counts[submask] += count
+            submask = (submask - 1) & mask
+            
+    return {combination: subset_counts[mask] for combination, mask in masks.items()}
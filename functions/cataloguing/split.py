@@ -4,10 +4,145 @@ import re
 from typing import Any, Dict, Union
 from pathlib import Path
 
+import numpy as np
 import pydicom
 
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
 import plotly.graph_objects as go
 
+from functions.utilities import read_dicom_header
+
+
+_digits = re.compile(r'\d+')
+
+
+def _close(value_a: Any, value_b: Any, tolerance: float) -> bool:
+    # Null values are only similar to each other
+    if value_a is None or value_b is None:
+        return value_a is value_b
+    return abs(value_a - value_b) <= tolerance
+
+
+class _SplitEntries():
+    """
+    The distinct metadata entries of a bucket, stored as a struct of arrays
+    (one contiguous array per compared value) so that a new series is compared
+    against all the entries at once. Null values are NaN.
+    """
+    
+    # Column layout of the entries
+    tolerance_columns = [0, 1, 2, 3, 4, 5]
+    tolerances = [0.5, 0.2, 0.1, 0.5, 5, 10]
+    pixel_spacing_null = 6
+    pixel_spacing_row = 7
+    pixel_spacing_column = 8
+    acquisition_matrix_null = 9
+    pixel_size_row = 10
+    pixel_size_column = 11
+    size = 12
+    
+    
+    def __init__(self) -> None:
+        capacity = 4
+        self.columns = np.empty((_SplitEntries.size, capacity))
+        # The split index (within the sequence key) of each entry
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.length = 0
+        # Scratch buffers of the comparison, reused so that no temporary
+        # arrays are created per compared value
+        self.__difference = np.empty(capacity)
+        self.__matched = np.empty(capacity, dtype=bool)
+        self.__similar = np.empty(capacity, dtype=bool)
+    
+    
+    def __match_close(self, column: int, value: float, tolerance: float) -> None:
+        # Either both null or within the tolerance (NaN differences never are)
+        difference = self.__difference[:self.length]
+        matched = self.__matched[:self.length]
+        if value != value:
+            np.isnan(self.columns[column, :self.length], out=matched)
+        else:
+            np.subtract(self.columns[column, :self.length], value, out=difference)
+            np.abs(difference, out=difference)
+            np.less_equal(difference, tolerance, out=matched)
+        np.logical_and(self.__similar[:self.length], matched, out=self.__similar[:self.length])
+        
+        
+    def __match_equal(self, column: int, value: float) -> None:
+        matched = self.__matched[:self.length]
+        np.equal(self.columns[column, :self.length], value, out=matched)
+        np.logical_and(self.__similar[:self.length], matched, out=self.__similar[:self.length])
+    
+    
+    def find(self, row: np.ndarray) -> int:
+        """
+        Returns the split index of the first entry similar to the passed row
+        (see MetadataSplit.is_similar()), or -1 if there is none.
+        """
+        if self.length == 0:
+            return -1
+        
+        similar = self.__similar[:self.length]
+        similar.fill(True)
+        
+        for column, tolerance in zip(_SplitEntries.tolerance_columns, _SplitEntries.tolerances):
+            self.__match_close(column, row[column], tolerance)
+        
+        # The pixel spacing (and with it the acquisition matrix) is only
+        # compared when it is set in both entries
+        if row[_SplitEntries.pixel_spacing_null]:
+            self.__match_equal(_SplitEntries.pixel_spacing_null, 1)
+        else:
+            self.__match_equal(_SplitEntries.pixel_spacing_null, 0)
+            self.__match_close(_SplitEntries.pixel_spacing_row, row[_SplitEntries.pixel_spacing_row], 0.1)
+            self.__match_close(_SplitEntries.pixel_spacing_column, row[_SplitEntries.pixel_spacing_column], 0.1)
+            if row[_SplitEntries.acquisition_matrix_null]:
+                self.__match_equal(_SplitEntries.acquisition_matrix_null, 1)
+            else:
+                self.__match_equal(_SplitEntries.acquisition_matrix_null, 0)
+                self.__match_close(_SplitEntries.pixel_size_row, row[_SplitEntries.pixel_size_row], 0.5)
+                self.__match_close(_SplitEntries.pixel_size_column, row[_SplitEntries.pixel_size_column], 0.5)
+        
+        # argmax stops at the first True value
+        index = int(similar.argmax())
+        if not similar[index]:
+            return -1
+        
+        return int(self.ids[index])
+    
+    
+    def append(self, row: np.ndarray, split_index: int) -> None:
+        # The capacity is doubled when full, so appending is amortised O(1)
+        if self.length == len(self.ids):
+            self.columns = np.concatenate((self.columns, np.empty_like(self.columns)), axis=1)
+            self.ids = np.concatenate((self.ids, np.empty_like(self.ids)))
+            self.__difference = np.empty(len(self.ids))
+            self.__matched = np.empty(len(self.ids), dtype=bool)
+            self.__similar = np.empty(len(self.ids), dtype=bool)
+            
+        self.columns[:, self.length] = row
+        self.ids[self.length] = split_index
+        self.length += 1
+
+
+class _SplitKeyEntries():
+    """
+    The split entries of a sequence key. The entries are bucketed by the values
+    that have to be equal for two entries to be similar, so a new series is
+    only compared with the entries of its own bucket.
+    """
+    
+    def __init__(self) -> None:
+        # Number of series per split, in split order
+        self.counts = []
+        self.buckets = {}
+        
+        
+    def __len__(self) -> int:
+        return len(self.counts)
+
 
 class MetadataSplit():
     
@@ -15,23 +150,59 @@ class MetadataSplit():
                     'NumberOfAverages', 'SpacingBetweenSlices', 'EchoTrainLength',
                     'FlipAngle', 'PixelSpacing', 'AcquisitionMatrix', 'Rows', 'Columns',
                     'MagneticFieldStrength', 'CardiacNumberOfImages']
+    # The tags resolved once from their keywords
+    __dicom_tag_ints = tuple(pydicom.datadict.tag_for_keyword(tag_key) for tag_key in __dicom_tags)
+    __character_set_tag = pydicom.datadict.tag_for_keyword('SpecificCharacterSet')
     
     
     def __init__(self):
         self.entries = {}
     
     
+    @staticmethod
+    def __float(value: Any) -> float:
+        if value is None or value == '':
+            return np.nan
+        return float(value)
+    
+    
+    @staticmethod
+    def __entry_row(metadata: Dict[str, Any]) -> np.ndarray:
+        # The metadata values in the _SplitEntries column layout
+        row = np.full(_SplitEntries.size, np.nan)
+        for column, tag_key in zip(_SplitEntries.tolerance_columns,
+                                   ['SliceThickness', 'RepetitionTime', 'EchoTime',
+                                    'SpacingBetweenSlices', 'EchoTrainLength', 'FlipAngle']):
+            row[column] = MetadataSplit.__float(metadata[tag_key])
+            
+        pixel_spacing = metadata['PixelSpacing']
+        acquisition_matrix = metadata['AcquisitionMatrix']
+        row[_SplitEntries.pixel_spacing_null] = pixel_spacing is None
+        row[_SplitEntries.acquisition_matrix_null] = acquisition_matrix is None
+        if pixel_spacing is not None:
+            row[_SplitEntries.pixel_spacing_row] = pixel_spacing[0]
+            row[_SplitEntries.pixel_spacing_column] = pixel_spacing[1]
+            
+            if acquisition_matrix is not None:
+                matrix_row = acquisition_matrix[0] if acquisition_matrix[0] != 0 else acquisition_matrix[2]
+                matrix_column = acquisition_matrix[1] if acquisition_matrix[1] != 0 else acquisition_matrix[3]
+                row[_SplitEntries.pixel_size_row] = metadata['Rows'] * pixel_spacing[0] / matrix_row
+                row[_SplitEntries.pixel_size_column] = metadata['Columns'] * pixel_spacing[1] / matrix_column
+                
+        return row
+    
+    
     @staticmethod
     def get_tag_info(dicom_directory: Union[str, Path]) -> Dict[str, Any]:
-        filename = os.listdir(dicom_directory)[0]
-        dataset = pydicom.dcmread(os.path.join(dicom_directory, filename))
+        with os.scandir(dicom_directory) as entries:
+            file_path = next(entry.path for entry in entries if entry.is_file())
+        # Only the split tags are read, the pixel data and other elements are skipped
+        dataset = read_dicom_header(file_path, specific_tags=[MetadataSplit.__character_set_tag,
+                                                              *MetadataSplit.__dicom_tag_ints])
         
         tags = {}
-        for tag_key in MetadataSplit.__dicom_tags:
-            try:
-                tags[tag_key] = dataset.data_element(tag_key).value
-            except:
-                tags[tag_key] = None
+        for tag_key, tag in zip(MetadataSplit.__dicom_tags, MetadataSplit.__dicom_tag_ints):
+            tags[tag_key] = dataset[tag].value if tag in dataset else None
             
         #if tags['SpacingBetweenSlices'] is None:
         #    tags['SpacingBetweenSlices'] = tags['SliceThickness']
@@ -45,7 +216,13 @@ class MetadataSplit():
     
         for tag_key in MetadataSplit.__dicom_tags:
             if tag_key == 'MRAcquisitionType':
-                expanded_values[tag_key] = re.findall(r'\d+', entry_values[tag_key])[0]
+                acquisition_type = entry_values[tag_key]
+                # The values are usually '2D' or '3D'
+                if (len(acquisition_type) == 2 and acquisition_type[0].isdigit()
+                    and not acquisition_type[1].isdigit()):
+                    expanded_values[tag_key] = acquisition_type[0]
+                else:
+                    expanded_values[tag_key] = _digits.search(acquisition_type).group()
             elif tag_key == 'PixelSpacing':
                 new_key = tag_key + 'Row'
                 expanded_values[new_key] = entry_values[tag_key][0]
@@ -69,52 +246,20 @@ class MetadataSplit():
     
     @staticmethod
     def is_similar(entry_a: Dict[str, Any], entry_b: Dict[str, Any]) -> bool:
-        def is_any_null(value_a: Any, value_b: Any) -> bool:
-            if value_a is None or value_b is None:
-                return True
-    
-        def is_both_null(value_a: Any, value_b: Any) -> bool:
-            if value_a is None and value_b is None:
-                return True
-    
         if entry_a['MRAcquisitionType'] != entry_b['MRAcquisitionType']:
             return False
         
-        if not is_both_null(entry_a['SliceThickness'], entry_b['SliceThickness']):
-            if (is_any_null(entry_a['SliceThickness'], entry_b['SliceThickness']) or
-                abs(entry_a['SliceThickness'] - entry_b['SliceThickness']) > 0.5):
-                return False
-        
-        if not is_both_null(entry_a['RepetitionTime'], entry_b['RepetitionTime']):
-            if (is_any_null(entry_a['RepetitionTime'], entry_b['RepetitionTime']) or
-                abs(entry_a['RepetitionTime'] - entry_b['RepetitionTime']) > 0.2):
-                return False
-        
-        if not is_both_null(entry_a['EchoTime'], entry_b['EchoTime']):
-            if (is_any_null(entry_a['EchoTime'], entry_b['EchoTime']) or
-                abs(entry_a['EchoTime'] - entry_b['EchoTime']) > 0.1):
-                return False
-        
         if entry_a['NumberOfAverages'] != entry_b['NumberOfAverages']:
             return False
         
-        if not is_both_null(entry_a['SpacingBetweenSlices'], entry_b['SpacingBetweenSlices']):
-            if (is_any_null(entry_a['SpacingBetweenSlices'], entry_b['SpacingBetweenSlices']) or
-                abs(entry_a['SpacingBetweenSlices'] - entry_b['SpacingBetweenSlices']) > 0.5):
-                return False
-        
-        if not is_both_null(entry_a['EchoTrainLength'], entry_b['EchoTrainLength']):
-            if (is_any_null(entry_a['EchoTrainLength'], entry_b['EchoTrainLength']) or
-                abs(entry_a['EchoTrainLength'] - entry_b['EchoTrainLength']) > 5):
+        for tag_key, tolerance in [('SliceThickness', 0.5), ('RepetitionTime', 0.2),
+                                   ('EchoTime', 0.1), ('SpacingBetweenSlices', 0.5),
+                                   ('EchoTrainLength', 5), ('FlipAngle', 10)]:
+            if not _close(entry_a[tag_key], entry_b[tag_key], tolerance):
                 return False
         
-        if not is_both_null(entry_a['FlipAngle'], entry_b['FlipAngle']):
-            if (is_any_null(entry_a['FlipAngle'], entry_b['FlipAngle']) or
-                abs(entry_a['FlipAngle'] - entry_b['FlipAngle']) > 10):
-                return False
-        
-        if not is_both_null(entry_a['PixelSpacing'], entry_b['PixelSpacing']):
-            if is_any_null(entry_a['PixelSpacing'], entry_b['PixelSpacing']):
+        if not (entry_a['PixelSpacing'] is None and entry_b['PixelSpacing'] is None):
+            if entry_a['PixelSpacing'] is None or entry_b['PixelSpacing'] is None:
                 return False
             
             if abs(entry_a['PixelSpacing'][0] - entry_b['PixelSpacing'][0]) > 0.1:
@@ -123,8 +268,8 @@ class MetadataSplit():
             if abs(entry_a['PixelSpacing'][1] - entry_b['PixelSpacing'][1]) > 0.1:
                 return False
         
-            if not is_both_null(entry_a['AcquisitionMatrix'], entry_b['AcquisitionMatrix']):
-                if is_any_null(entry_a['AcquisitionMatrix'], entry_b['AcquisitionMatrix']):
+            if not (entry_a['AcquisitionMatrix'] is None and entry_b['AcquisitionMatrix'] is None):
+                if entry_a['AcquisitionMatrix'] is None or entry_b['AcquisitionMatrix'] is None:
                     return False
                 
                 row_a = entry_a['AcquisitionMatrix'][0] if entry_a['AcquisitionMatrix'][0] != 0 else entry_a['AcquisitionMatrix'][2]
@@ -160,23 +305,28 @@ class MetadataSplit():
         #key = type_label + '+' + ('' if anatomy_label is None else anatomy_label)
         key = type_label + ('' if anatomy_label is None else '_' + anatomy_label)
         
-        split_id = -1
+        if key not in self.entries:
+            self.entries[key] = _SplitKeyEntries()
+        key_entries = self.entries[key]
         
-        if key in self.entries:
-            entry_list = self.entries[key]
-            for i in range(len(entry_list)):
-                if self.is_similar(metadata, entry_list[i]['values']):
-                    entry_list[i]['count'] += 1
-                    split_id = i + 1
-                    return split_id
-            
-            new_entry = {'values': metadata, 'count': 1}
-            entry_list.append(new_entry)
-            split_id = len(entry_list)
+        # Only entries with the same values for these tags can be similar
+        bucket = (metadata['MRAcquisitionType'], metadata['MagneticFieldStrength'],
+                  metadata['NumberOfAverages'], metadata['CardiacNumberOfImages'])
+        if bucket not in key_entries.buckets:
+            key_entries.buckets[bucket] = _SplitEntries()
+        entries = key_entries.buckets[bucket]
+        
+        # The metadata is compared with all the entries of the bucket at once
+        row = MetadataSplit.__entry_row(metadata)
+        index = entries.find(row)
+        if index >= 0:
+            key_entries.counts[index] += 1
         else:
-            entry = [{'values': metadata, 'count': 1}]
-            self.entries[key] = entry
-            split_id = 1    
+            index = len(key_entries)
+            entries.append(row, index)
+            key_entries.counts.append(1)
+            
+        split_id = index + 1
             
         return split_id
     
@@ -185,7 +335,8 @@ class MetadataSplit():
         
         if output_path is None:
             output_path = Path('.')
-        new_output_path = os.path.join(output_path, 'splits')
+        output_path = Path(output_path)
+        new_output_path = output_path / 'splits'
         os.makedirs(new_output_path, exist_ok=True)
         
         for key, values in self.entries.items():
@@ -199,7 +350,7 @@ class MetadataSplit():
                 color.append('red')
                 source.append(0)
                 target.append(i + 1)
-                value.append(values[i]['count'])
+                value.append(int(values.counts[i]))
                 
             fig = go.Figure(data=[go.Sankey(
                 node = dict(
@@ -217,24 +368,21 @@ class MetadataSplit():
             
             fig.update_layout(title_text=key + ' Breakdown', font_size=14)
                 
-            fig.write_html(os.path.join(new_output_path, key + '.html'))
+            fig.write_html(str(new_output_path / (key + '.html')))
             
-        import matplotlib.pyplot as plt
-        import numpy as np
-        
         key = 'CINE_LVSA'
         values = self.entries[key]
-        data = []
-        for i in values:
-            data.append(i['count'])
+        data = list(values.counts)
         
         print(data)
-        fig = plt.figure()
-        plt.title('CINE LVSA Groups Split')
-        plt.xlabel('Group Index')
-        plt.ylabel('Total Datasets')
-        #plt.hist(data, bins=range(len(data), len(data) + 1, 1))
-        
-        plt.bar(np.arange(len(data)), data)
-        fig.savefig('catalogue_output\\cine_lvsa_groups.png', bbox_inches='tight')
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        ax.set_title('CINE LVSA Groups Split')
+        ax.set_xlabel('Group Index')
+        ax.set_ylabel('Total Datasets')
+        #ax.hist(data, bins=range(len(data), len(data) + 1, 1))
+        
+        ax.bar(np.arange(len(data)), data)
+        fig.savefig(output_path / 'cine_lvsa_groups.png', bbox_inches='tight')
         
@@ -1,17 +1,258 @@
 import os
+import re
+import errno
+import logging
+import hashlib
 import zipfile
 import shutil
+import multiprocessing
 
-from typing import Union
+from io import BytesIO
+from itertools import repeat
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Dict, List, Tuple, Union
 from pathlib import Path
 
+import pydicom
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where reflinks are not used
+    fcntl = None
+
+from functions.fastwalk import iter_dicom_files
+from functions.utilities import directory_folders, pin_worker, read_dicom_header
+
+
+logger = logging.getLogger(__name__)
+
+# The tags that define the sorted series folder of a DICOM file
+_sort_tags = ['SeriesNumber', 'AcquisitionNumber', 'SeriesDescription']
+
+# Characters that cannot be used in folder names
+_invalid_folder_characters = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+
+# The ways of placing a sorted file in the target folder, in order of
+# preference: a copy-on-write clone, a hard link or a full copy
+link_modes = ['reflink', 'hardlink', 'copy']
+
+# Link modes found to be unsupported between the source and target folders
+_unsupported_link_modes = set()
+_unsupported_link_errors = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP,
+                            errno.ENOTTY, errno.EINVAL, errno.ENOSYS}
+
+# ioctl request cloning a file (Linux)
+_FICLONE = 0x40049409
+
+# Buffer size of the file copies
+_copy_buffer_size = 1 << 20
+
+
+def _series_folder_name(dataset: pydicom.Dataset) -> str:
+    # Folder naming has the format: Series<number>-<acquisition>_<series_description>,
+    # without '-<acquisition>' if the acquisition number is missing. The
+    # acquisition is kept before the first '_', where the later steps expect
+    # the series description to start.
+    series_number = dataset.get('SeriesNumber', None)
+    acquisition_number = dataset.get('AcquisitionNumber', None)
+    series_description = dataset.get('SeriesDescription', None)
+    
+    series_number = 'Unknown' if series_number is None else str(series_number)
+    if acquisition_number is not None and str(acquisition_number) != '':
+        series_number += '-' + str(acquisition_number)
+    series_description = '' if series_description is None else str(series_description)
+    
+    return 'Series' + series_number + '_' + _invalid_folder_characters.sub('_', series_description)
+
+
+def _reflink(source_file: str, target_file: str) -> None:
+    # Copy-on-write clone of the file data (e.g. Btrfs, XFS), so no data is
+    # copied until either file is modified
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this platform')
+    # The target is created exclusively, so an existing file is never
+    # truncated (it may be a hard link to another source file)
+    with open(source_file, 'rb') as source, open(target_file, 'xb') as target:
+        try:
+            fcntl.ioctl(target.fileno(), _FICLONE, source.fileno())
+        except OSError:
+            target.close()
+            os.remove(target_file)
+            raise
+
+
+def _copy(source_file: str, target_file: str) -> None:
+    # shutil.copy2 copies in 16 KiB chunks (Python 3.7), which takes many read
+    # and write calls for multi-megabyte files
+    with open(source_file, 'rb') as source, open(target_file, 'xb') as target:
+        shutil.copyfileobj(source, target, _copy_buffer_size)
+    shutil.copystat(source_file, target_file)
+
+
+_link_functions = {'reflink': _reflink, 'hardlink': os.link}
+
+
+def _link_or_copy(source_file: str, target_file: str, link_mode: str = 'copy') -> None:
+    # Tries the given link mode first, falling back to the next (cheaper to
+    # support) modes in order when the file systems do not support it. Other
+    # errors are raised, e.g. FileExistsError if the target file exists.
+    for mode in link_modes[link_modes.index(link_mode):]:
+        if mode == 'copy':
+            _copy(source_file, target_file)
+            return
+        if mode in _unsupported_link_modes:
+            continue
+        
+        try:
+            _link_functions[mode](source_file, target_file)
+            return
+        except OSError as error:
+            # Not retried for the next files if the file system does not
+            # support the mode at all
+            if error.errno not in _unsupported_link_errors:
+                raise
+            if mode not in _unsupported_link_modes:
+                _unsupported_link_modes.add(mode)
+                logger.warning("Link mode '%s' is not supported (%s), falling back to '%s'",
+                               mode, error.strerror, link_modes[link_modes.index(mode) + 1])
+
+
+def _create_file(place_file, folder: str, file_name: str) -> None:
+    # Creates a file in the folder with place_file(target_file), which must
+    # fail with FileExistsError if the target exists. Files with the same name
+    # (e.g. from different source subfolders) are given a numbered suffix.
+    name, extension = os.path.splitext(file_name)
+    target_file = folder + os.sep + file_name
+    duplicate_index = 1
+    while True:
+        try:
+            place_file(target_file)
+            return
+        except FileExistsError:
+            target_file = folder + os.sep + name + '_' + str(duplicate_index) + extension
+            duplicate_index += 1
+
+
+def _sort_file(file_path: str, target_folder: Union[str, Path], series_folders: Dict[str, str],
+               link_mode: str) -> None:
+    dataset = read_dicom_header(file_path, specific_tags=_sort_tags)
+    series_folder_name = _series_folder_name(dataset)
+    
+    # A folder may be created by two threads at once, which is harmless
+    series_folder = series_folders.get(series_folder_name)
+    if series_folder is None:
+        series_folder = os.path.join(target_folder, series_folder_name)
+        os.makedirs(series_folder, exist_ok=True)
+        series_folders[series_folder_name] = series_folder
+        
+    _create_file(lambda target_file: _link_or_copy(file_path, target_file, link_mode),
+                 series_folder, os.path.basename(file_path))
+
+
+def _sort_patient(source_folder: Union[str, Path], target_folder: Union[str, Path],
+                  executor: ThreadPoolExecutor, link_mode: str) -> None:
+    # Series folder name to its (created) path, so that it is joined once
+    series_folders = {}
+    # The header reads and the links/copies are I/O bound, so the files are
+    # sorted by a thread pool
+    for _ in executor.map(_sort_file, iter_dicom_files(source_folder),
+                          repeat(target_folder), repeat(series_folders), repeat(link_mode)):
+        pass
+
+
+def _file_digest(file_path: str, hasher: str) -> str:
+    digest = hashlib.new(hasher)
+    with open(file_path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(_copy_buffer_size), b''):
+            digest.update(chunk)
+            
+    return digest.hexdigest()
+
 
-def sort(source_dir: Union[str, Path], target_dir: Union[str, Path]) -> None:
+def _folder_files(folder: Union[str, Path]) -> List[str]:
+    # The paths of the DICOM files in the folder, at any depth, found as the
+    # sort does (see iter_dicom_files())
+    return list(iter_dicom_files(folder))
+
+
+def _sorted_folder_files(folder: Union[str, Path]) -> List[str]:
+    # The paths of the DICOM files in the series subfolders of the folder
+    with os.scandir(folder) as subfolder_entries:
+        subfolders = [entry.path for entry in subfolder_entries if entry.is_dir()]
+        
+    return [file_path for subfolder in subfolders for file_path in _folder_files(subfolder)]
+
+
+def _count_files(folder: Union[str, Path]) -> Tuple[int, int]:
+    # The number and total size (bytes) of the DICOM files in the folder, at
+    # any depth, found as the sort does (see iter_dicom_files())
+    files_num = 0
+    files_size = 0
+    for file_path in iter_dicom_files(folder):
+        files_num += 1
+        files_size += os.stat(file_path).st_size
+                
+    return files_num, files_size
+
+
+def _count_sorted_files(folder: Union[str, Path]) -> Tuple[int, int]:
+    # The number and total size (bytes) of the DICOM files in the series
+    # subfolders of the folder
+    with os.scandir(folder) as subfolder_entries:
+        subfolders = [entry.path for entry in subfolder_entries if entry.is_dir()]
+        
+    files_num = 0
+    files_size = 0
+    for subfolder in subfolders:
+        subfolder_num, subfolder_size = _count_files(subfolder)
+        files_num += subfolder_num
+        files_size += subfolder_size
+        
+    return files_num, files_size
+
+
+def _write_file(target_file: str, data: bytes) -> None:
+    with open(target_file, 'xb') as fp:
+        fp.write(data)
+
+
+def _sort_patient_archive(source_archive: Union[str, Path], target_folder: Union[str, Path]) -> None:
+    # The members are read straight from the archive, without extracting them
+    # to a temporary folder first
+    series_folders = {}
+    with zipfile.ZipFile(source_archive, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir() or not info.filename.lower().endswith('.dcm'):
+                continue
+            
+            data = zip_ref.read(info)
+            dataset = pydicom.dcmread(BytesIO(data), stop_before_pixels=True,
+                                      specific_tags=_sort_tags)
+            series_folder_name = _series_folder_name(dataset)
+            
+            series_folder = series_folders.get(series_folder_name)
+            if series_folder is None:
+                series_folder = os.path.join(target_folder, series_folder_name)
+                os.makedirs(series_folder, exist_ok=True)
+                series_folders[series_folder_name] = series_folder
+                
+            _create_file(lambda target_file: _write_file(target_file, data),
+                         series_folder, info.filename.rsplit('/', 1)[-1])
+
+
+def sort(source_dir: Union[str, Path], target_dir: Union[str, Path],
+         threads: Union[int, None] = None, link_mode: str = 'copy',
+         progress: bool = True, pin: bool = False) -> None:
     """
     Sorts the DICOM files based on the sequence description per patient ID. Not
-    an inplace operation. The files are copied over to the new target directory
-    structured in subfolders. The input patient folders are expected to be
-    compressed in a 'zip' format.
+    an inplace operation. The files are cloned, hard linked or copied (see
+    'link_mode') to the new target directory, structured in subfolders named
+    'Series<number>-<acquisition number>_<series_description>'. The input patient folders can be
+    compressed in a 'zip' format, in which case the files are read directly
+    from the archive.
     
     Note:
         If the folder already exists in the target directory it will assume that
@@ -27,56 +268,77 @@ def sort(source_dir: Union[str, Path], target_dir: Union[str, Path]) -> None:
     target_dir : Union[str, Path]
         A string or Path object of the output directory of the sorted DICOM
         files.
+    threads : Union[int, None], optional
+        The number of threads sorting the files of a patient. The default is
+        None, which uses four times the number of processors (at most 32).
+    link_mode : str, optional
+        How the files are placed in the target directory, one of 'reflink'
+        (copy-on-write clone), 'hardlink' or 'copy'. If a mode is not
+        supported, the next one in this order is used, which is logged once.
+        Hard linked files share their data with the source files, so any
+        change to either is seen by both. The default is 'copy'. Files from
+        zip archives are always written out.
+    progress : bool, optional
+        Whether to print the progress (the patient folders being sorted or
+        skipped). The default is True.
+    pin : bool, optional
+        Whether to pin each sorting thread to a single processor (see
+        utilities.pin_worker()). The default is False.
 
     Returns
     -------
     None
 
     """
+    if threads is None:
+        threads = min(32, (os.cpu_count() or 1) * 4)
+        
     os.makedirs(target_dir, exist_ok=True)
+    # The supported link modes depend on the source and target file systems
+    _unsupported_link_modes.clear()
     
-    for folder_name in next(os.walk(source_dir))[1]:
-        if folder_name.startswith('.'):
-            continue
-        
-        source_folder = os.path.join(source_dir, folder_name)
-        
-        new_folder_name = folder_name
-        compressed = False
-        if folder_name.endswith('.zip'):
-            compressed = True
-            new_folder_name = folder_name[:-4]
-        target_folder = os.path.join(target_dir, new_folder_name)        
-        
-        if os.path.isdir(target_folder):
-            print("Folder '" + new_folder_name + "' already exists. Skipping...")
-            continue
-        
-        
-        if compressed:
-            target_zip_folder = os.path.join(target_dir, 'temp_' + new_folder_name)
-            print('Unzipping folder to: ' + target_zip_folder)
-            os.makedirs(target_zip_folder, exist_ok=True)
+    with os.scandir(source_dir) as entries:
+        patient_entries = [entry for entry in entries
+                           if entry.is_dir() or (entry.name.endswith('.zip') and entry.is_file())]
+    
+    pool_arguments = {}
+    if pin:
+        pool_arguments = {'initializer': pin_worker, 'initargs': (multiprocessing.Value('i', 0),)}
+    with ThreadPoolExecutor(max_workers=threads, **pool_arguments) as executor:
+        for patient_entry in patient_entries:
+            folder_name = patient_entry.name
+            if folder_name.startswith('.'):
+                continue
             
-            with zipfile.ZipFile(source_folder , 'r') as zip_ref:
-                zip_ref.extractall(target_zip_folder)
-                
-            source_folder = target_zip_folder
+            source_folder = patient_entry.path
             
-        
-        print("Sorting '" + new_folder_name + "':")
-        folder_st = '\"' + source_folder +  '\" ' + '\"' + target_folder +  '\"'        
-        os.system('dicomsorter ' + folder_st + ' --path SeriesNumber --path AcquisitionNumber --path SeriesDescription') #--path SeriesNumber InstanceNumber SeriesDescription
-        
-        if compressed:
-            print('\nRemoving temporary folder: ' + target_zip_folder)
-            shutil.rmtree(target_zip_folder)
+            new_folder_name = folder_name
+            compressed = False
+            if folder_name.endswith('.zip'):
+                compressed = True
+                new_folder_name = folder_name[:-4]
+            target_folder = os.path.join(target_dir, new_folder_name)        
+            
+            if os.path.isdir(target_folder):
+                if progress:
+                    print("Folder '" + new_folder_name + "' already exists. Skipping...")
+                continue
+            
+            
+            if progress:
+                print("Sorting '" + new_folder_name + "':")
+            if compressed:
+                _sort_patient_archive(source_folder, target_folder)
+            else:
+                _sort_patient(source_folder, target_folder, executor, link_mode)
 
 
-def validate(source_dir: Union[str, Path], target_dir: Union[str, Path]) -> None:
+def validate(source_dir: Union[str, Path], target_dir: Union[str, Path],
+             threads: Union[int, None] = None, hasher: Union[str, None] = None) -> None:
     """
     Checks the file number and the total file size between the given source
-    and target directories. Any differences are reported to the standard output.
+    and target directories. Optionally, the file contents are also compared
+    through their digests. Any differences are reported to the standard output.
 
     Parameters
     ----------
@@ -84,16 +346,22 @@ def validate(source_dir: Union[str, Path], target_dir: Union[str, Path]) -> None
         A string os Path object of the anonymised root directory.
     target_dir : Union[str, Path]
         A string os Path object of the sorted root directory.
+    threads : Union[int, None], optional
+        The number of threads counting the files of the patient folders. The
+        default is None, which uses four times the number of processors (at
+        most 32).
+    hasher : Union[str, None], optional
+        The name of the hashlib algorithm (e.g. 'sha256') with which the
+        contents of the source and target files are compared. The default is
+        None, which does not compare the contents.
 
     Returns
     -------
     None
 
     """
-    from functions.utilities import direcotry_folders
-    
-    source_folders = set(direcotry_folders(source_dir))
-    target_folders = set(direcotry_folders(target_dir))
+    source_folders = set(directory_folders(source_dir))
+    target_folders = set(directory_folders(target_dir))
     
     # Check for missing patient folders
     missing_folders = source_folders - target_folders
@@ -109,29 +377,37 @@ def validate(source_dir: Union[str, Path], target_dir: Union[str, Path]) -> None
     # Check the number of files under each patient folder
     scan_folders = source_folders.intersection(target_folders)
 
+    if threads is None:
+        threads = min(32, (os.cpu_count() or 1) * 4)
+        
     # Compare the number of files and byte size in source against target    
-    for folder in scan_folders:
-        source_files_num = 0
-        source_files_size = 0
-        target_files_num = 0
-        target_files_size = 0
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        source_counts = executor.map(_count_files, [os.path.join(source_dir, folder)
+                                                    for folder in scan_folders])
+        target_counts = executor.map(_count_sorted_files, [os.path.join(target_dir, folder)
+                                                           for folder in scan_folders])
         
-        for file in os.listdir(os.path.join(source_dir, folder)):
-            if file.endswith('.dcm'):
-                source_files_num += 1
-                source_files_size += os.path.getsize(os.path.join(source_dir, folder, file))
-                
-        for subfolder in next(os.walk(os.path.join(target_dir, folder)))[1]:
-            for file in os.listdir(os.path.join(target_dir, folder, subfolder)):
-                if file.endswith('.dcm'):
-                    target_files_num += 1
-                    target_files_size += os.path.getsize(os.path.join(target_dir, folder, subfolder, file))
-                                                      
+        for folder, (source_files_num, source_files_size), (target_files_num, target_files_size) \
+            in zip(scan_folders, source_counts, target_counts):
+            if source_files_num != target_files_num or source_files_size != target_files_size:
+                print(('Mismatch files between source and target for patient {}: \
+                       \nSource files: Number: {}, Size (bytes): {}\nTarget files: Number: {}, Size (bytes): {}\n')
+                      .format(folder, source_files_num, source_files_size, target_files_num, target_files_size))
                 
-        if source_files_num != target_files_num or source_files_size != target_files_size:
-            print(('Mismatch files between source and target for patient {}: \
-                   \nSource files: Number: {}, Size (bytes): {}\nTarget files: Number: {}, Size (bytes): {}\n')
-                  .format(folder, source_files_num, source_files_size, target_files_num, target_files_size))
+        if hasher is not None:
+            for folder in scan_folders:
+                # Every source file should have a target file with identical content
+                source_digests = Counter(executor.map(_file_digest,
+                                                      _folder_files(os.path.join(source_dir, folder)),
+                                                      repeat(hasher)))
+                target_digests = Counter(executor.map(_file_digest,
+                                                      _sorted_folder_files(os.path.join(target_dir, folder)),
+                                                      repeat(hasher)))
+                unmatched_files_num = sum((source_digests - target_digests).values())
+                if unmatched_files_num > 0:
+                    print('Mismatch file contents between source and target for patient {}: '
+                          '{} source files have no identical target file\n'
+                          .format(folder, unmatched_files_num))
         
 
 if __name__ == '__main__':
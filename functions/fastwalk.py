@@ -0,0 +1,41 @@
+import os
+
+from collections import deque
+from typing import Iterator, Union
+from pathlib import Path
+
+
+def iter_dicom_files(root_directory: Union[str, Path]) -> Iterator[str]:
+    """
+    Generator of all DICOM files (extension '.dcm', case insensitive) under the
+    given directory, at any depth. The directory tree is walked with
+    os.scandir, so the entry types come with the directory listing and no
+    stat call or Path object is needed per entry. Symbolic links to
+    directories are not followed.
+
+    Parameters
+    ----------
+    root_directory : Union[str, Path]
+        The directory to search for DICOM files.
+
+    Yields
+    ------
+    str
+        The full path to a DICOM file.
+
+    """
+    pending_directories = deque([os.fspath(root_directory)])
+    while pending_directories:
+        # Depth-first, so the files of a folder are yielded together
+        directory = pending_directories.pop()
+        subdirectories = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                # Check the name first as it does not require a stat call
+                elif entry.name.lower().endswith('.dcm') and entry.is_file():
+                    yield entry.path
+
+        # Reversed, so the subdirectories are walked in listing order
+        pending_directories.extend(reversed(subdirectories))
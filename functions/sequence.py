@@ -3,12 +3,70 @@ import csv
 
 import pandas as pd
 
-from typing import Dict, Union, Set
+from typing import Dict, Iterator, List, Union, Set
 from pathlib import Path
 
 from pivottablejs import pivot_ui
 
 from functions.cataloguing import group
+from functions.utilities import directory_folders
+
+
+def patient_descriptions(directory: Union[str, Path]) -> Dict[str, List[str]]:
+    """
+    Returns the sequence descriptions of each patient from a given sorted
+    directory. The description is extracted from the folder name and is
+    expected to be formated as 'Series<number>_<sequence_description>'.
+
+    Parameters
+    ----------
+    directory : Union[str, Path]
+        The directory to the sorted root folder. The expected format is as following:
+            directory/<patient_folder>/<sequence_folder>/<dicom_files>
+
+    Returns
+    -------
+    Dict[str, List[str]]
+        The patient folder names as keys and the sequence descriptions of
+        each patient as values.
+
+    """
+    descriptions = {}
+    for folder_name in directory_folders(directory):
+        series_descriptions = []
+        for subfolder_name in directory_folders(os.path.join(directory, folder_name)):
+            # Folder naming is expected to have the format: Series<number>_<series_description>
+            _, _, series_description = subfolder_name.partition('_')
+            series_descriptions.append(series_description)
+        descriptions[folder_name] = series_descriptions
+        
+    return descriptions
+
+
+def iter_descriptions(directory: Union[str, Path]) -> Iterator[str]:
+    """
+    Generator of the sequence descriptions of all the patients from a given
+    sorted directory, one per sequence folder (so including duplicates). The
+    description is extracted from the folder name and is expected to be
+    formated as 'Series<number>_<sequence_description>'.
+
+    Parameters
+    ----------
+    directory : Union[str, Path]
+        The directory to the sorted root folder. The expected format is as following:
+            directory/<patient_folder>/<sequence_folder>/<dicom_files>
+
+    Yields
+    ------
+    str
+        The sequence description of a sequence folder.
+
+    """
+    for folder_name in directory_folders(directory):
+        for subfolder_name in directory_folders(os.path.join(directory, folder_name)):
+            # Folder naming is expected to have the format: Series<number>_<series_description>
+            _, _, series_description = subfolder_name.partition('_')
+            yield series_description
 
 
 def get_descriptions(directory: Union[str, Path]) -> Set[str]:
@@ -29,14 +87,7 @@ def get_descriptions(directory: Union[str, Path]) -> Set[str]:
         All unique sequence descriptions found as a set object.
 
     """
-    unique_descriptions = set()
-    for folder_name in next(os.walk(directory))[1]:
-        for subfolder_name in next(os.walk(os.path.join(directory, folder_name)))[1]:
-            # Folder naming is expected to have the format: Series<number>_<series_description>
-            series_description = subfolder_name.split('_', 1)[1]
-            unique_descriptions.add(series_description)
-    
-    return unique_descriptions
+    return set(iter_descriptions(directory))
     
 
 def create_csv_descriptions(descriptions: Set[str]) -> None:
@@ -72,8 +123,7 @@ def create_csv_descriptions(descriptions: Set[str]) -> None:
         csvwriter.writerow(header_labels)
             
         # writing the data rows
-        for row in list_descriptions:
-            csvwriter.writerows([[row]])
+        csvwriter.writerows([[row, ''] for row in list_descriptions])
     
 
 def read_csv_descriptor_renaming() -> Dict[str, str]:
@@ -90,15 +140,13 @@ def read_csv_descriptor_renaming() -> Dict[str, str]:
 
     """
     filename = 'sequence_descriptors.csv'
-    rename_mapping = {}
     
-    with open(filename, 'r') as csv_file:
+    with open(filename, 'r', newline='') as csv_file:
         csv_reader = csv.reader(csv_file)
         _ = next(csv_reader)  # skip header
         
-        for row in csv_reader:
-            if row[1] != '':
-                rename_mapping[row[0]] = row[1]
+        # Rows without a rename label (or with the column missing) are skipped
+        rename_mapping = {row[0]: row[1] for row in csv_reader if len(row) >= 2 and row[1] != ''}
     
     return rename_mapping
     
@@ -124,33 +172,39 @@ def rename_descriptors(directory: Union[str, Path], rename: Union[Dict[str, str]
     None
 
     """
-    for folder_name in next(os.walk(directory))[1]:
-        for subfolder_name in next(os.walk(os.path.join(directory, folder_name)))[1]:
+    if rename is not None and not rename:
+        return  # nothing to rename
+    
+    # The renames are collected first and applied once the listing is done
+    renames = []
+    for folder_name in directory_folders(directory):
+        root_directory = os.path.join(directory, folder_name)
+        for subfolder_name in directory_folders(root_directory):
             # Folder naming is expected to have the format: Series<number>_<series_description>
-            series, description = subfolder_name.split('_', 1)
+            series, _, description = subfolder_name.partition('_')
 
             if rename is None:
                 labels = group.Categories.get_label(description)
                 if labels['type'] == 'Other':
                     continue
-                new_folder_name = series + '_' + labels['type']
+                new_description = labels['type']
                 if not labels['anatomy'] is None:
-                    new_folder_name = new_folder_name + '_' + labels['anatomy']
-                    
-                root_directory = os.path.join(directory, folder_name)
-                
-                os.rename(os.path.join(root_directory, subfolder_name),
-                          os.path.join(root_directory, new_folder_name))
-            # Check if the series description needs to be renamed            
-            elif description in rename:
-                new_folder_name = series + '_' + rename[description]
-                root_directory = os.path.join(directory, folder_name)
+                    new_description = new_description + '_' + labels['anatomy']
+            else:
+                # Check if the series description needs to be renamed
+                new_description = rename.get(description)
+                if new_description is None:
+                    continue
                 
-                os.rename(os.path.join(root_directory, subfolder_name),
-                          os.path.join(root_directory, new_folder_name))
+            renames.append((root_directory + os.sep + subfolder_name,
+                            root_directory + os.sep + series + '_' + new_description))
+            
+    for folder_path, new_folder_path in renames:
+        os.rename(folder_path, new_folder_path)
     
     
-def get_dataframe(directory: Union[str, Path]) -> pd.DataFrame:
+def get_dataframe(directory: Union[str, Path],
+                  descriptions: Union[Dict[str, List[str]], None] = None) -> pd.DataFrame:
     """
     Returns a DataFrame inidcating which sequence labels are available for each
     patient ID. Sequence descriptions marked with '0' for a patient indicates
@@ -161,6 +215,10 @@ def get_dataframe(directory: Union[str, Path]) -> pd.DataFrame:
     directory : Union[str, Path]
         The directory to the sorted root folder. The expected format is as following:
             directory/<patient_folder>/<sequence_folder>/<dicom_files>
+    descriptions : Union[Dict[str, List[str]], None], optional
+        The sequence descriptions of each patient, as returned by
+        patient_descriptions(). The default is None, which reads them from
+        the directory.
 
     Returns
     -------
@@ -168,24 +226,32 @@ def get_dataframe(directory: Union[str, Path]) -> pd.DataFrame:
         A DataFrame containing all the sequence labels for each patient ID.
 
     """
-    descriptions = get_descriptions(directory)
+    if descriptions is None:
+        descriptions = patient_descriptions(directory)
+    unique_descriptions = set()
+    for series_descriptions in descriptions.values():
+        unique_descriptions.update(series_descriptions)
     
     dataset_key = 'Dataset'
-    column_labels = list(descriptions)
+    column_labels = list(unique_descriptions)
     column_labels.sort()
     column_labels.insert(0, dataset_key)
 
-    df = pd.DataFrame(columns=column_labels)    
-    
-    for folder_name in next(os.walk(directory))[1]:
-        row = dict.fromkeys(descriptions, 0)
+    # Collect the rows first and build the dataframe once, as appending to a
+    # dataframe copies it every time
+    empty_row = dict.fromkeys(unique_descriptions, 0)
+    rows = []
+    for folder_name, series_descriptions in descriptions.items():
+        row = empty_row.copy()
         row[dataset_key] = folder_name
-        for subfolder_name in next(os.walk(os.path.join(directory, folder_name)))[1]:
-            # Folder naming is expected to have the format: Series<number>_<series_description>
-            description = subfolder_name.split('_', 1)[1]
+        for description in series_descriptions:
             row[description] = 1
             
-        df = df.append(row, ignore_index=True)
+        rows.append(row)
+        
+    df = pd.DataFrame(rows, columns=column_labels)
+    # The availability flags only need a byte each
+    df = df.astype(dict.fromkeys(unique_descriptions, 'int8'))
         
     return df
 
@@ -212,3 +278,32 @@ def create_html_csv_table(directory: Union[str, Path]) -> None:
     pivot_ui(df, outfile_path='patient_sequences.html')
     df.to_csv('patient_sequences.csv', index=False)
 
+
+def summarise(directory: Union[str, Path]) -> None:
+    """
+    Creates the outputs of both create_csv_descriptions() (with the unique
+    sequence descriptions) and create_html_csv_table() from a single read of
+    the sorted directory.
+
+    Parameters
+    ----------
+    directory : Union[str, Path]
+        The directory to the sorted root folder. The expected format is as following:
+            directory/<patient_folder>/<sequence_folder>/<dicom_files>
+
+    Returns
+    -------
+    None
+
+    """
+    descriptions = patient_descriptions(directory)
+    
+    unique_descriptions = set()
+    for series_descriptions in descriptions.values():
+        unique_descriptions.update(series_descriptions)
+    create_csv_descriptions(unique_descriptions)
+    
+    df = get_dataframe(directory, descriptions)
+    pivot_ui(df, outfile_path='patient_sequences.html')
+    df.to_csv('patient_sequences.csv', index=False)
+
@@ -1,8 +1,12 @@
 import os
+import mmap
 
-from typing import List, Union
+from multiprocessing.sharedctypes import Synchronized
+from typing import List, Sequence, Union
 from pathlib import Path
 
+import pydicom
+
 
 def directory_folders(directory: Union[str, Path]) -> List[str]:
     """
@@ -19,7 +23,74 @@ def directory_folders(directory: Union[str, Path]) -> List[str]:
         A list of strings of all the folder names found.
 
     """
-    folder_list = [folder_name for folder_name in os.listdir(directory)
-                   if os.path.isdir(os.path.join(directory, folder_name))]
+    # The entry types come with the directory listing, without a stat per entry
+    with os.scandir(directory) as entries:
+        folder_list = [entry.name for entry in entries if entry.is_dir(follow_symlinks=False)]
+    
+    return folder_list
+
+
+# Backwards-compatible alias of the previously misspelled name
+direcotry_folders = directory_folders
+
+
+def pin_worker(worker_counter: Synchronized) -> None:
+    """
+    Pool worker initializer pinning the calling worker (process or thread) to a
+    single processor, so the scheduler does not migrate it between processors
+    and their caches. The workers are assigned the processors available to the
+    process in turn, in the order they start. Processor affinity is only set
+    where supported (e.g. not on Windows or macOS).
+
+    Parameters
+    ----------
+    worker_counter : Synchronized
+        A shared integer counting the started workers of the pool, created
+        with multiprocessing.Value('i', 0).
+
+    Returns
+    -------
+    None
+
+    """
+    if not hasattr(os, 'sched_setaffinity'):
+        return
     
-    return folder_list
\ No newline at end of file
+    with worker_counter.get_lock():
+        worker_index = worker_counter.value
+        worker_counter.value += 1
+        
+    processors = sorted(os.sched_getaffinity(0))
+    # On Linux this pins only the calling thread
+    os.sched_setaffinity(0, {processors[worker_index % len(processors)]})
+
+
+def read_dicom_header(file_path: Union[str, Path],
+                      specific_tags: Union[Sequence[Union[str, int]], None] = None) -> pydicom.Dataset:
+    """
+    Reads the header of a DICOM file, stopping before the pixel data. The file
+    is memory-mapped, so only the pages holding the parsed elements are read
+    and no copies of the file data are made in user space.
+
+    Parameters
+    ----------
+    file_path : Union[str, Path]
+        The path to the DICOM file.
+    specific_tags : Union[Sequence[Union[str, int]], None], optional
+        The keywords or tags of the elements to read. The default is None,
+        which reads all the header elements.
+
+    Returns
+    -------
+    pydicom.Dataset
+        The dataset of the read header elements.
+
+    """
+    with open(file_path, 'rb') as fp:
+        try:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                return pydicom.dcmread(mapped_file, stop_before_pixels=True,
+                                       specific_tags=specific_tags)
+        except ValueError:
+            # Empty files cannot be mapped
+            return pydicom.dcmread(fp, stop_before_pixels=True, specific_tags=specific_tags)
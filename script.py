@@ -1,8 +1,38 @@
+import os
+import time
+import logging
 import argparse
 
+from typing import Union
 from pathlib import Path
 
-from functions import anonymise_mri, catalogue, dicom_sort, sequence
+logger = logging.getLogger(__name__)
+
+# The operation modules (and with them pydicom, pandas, matplotlib etc.) are
+# imported in the operation functions, so that only the modules of the
+# executed operation are loaded
+
+
+def directory_path(value: str) -> Union[Path, None]:
+    """
+    Converts a directory argument to a Path object, ignoring surrounding
+    whitespace.
+
+    Parameters
+    ----------
+    value : str
+        The passed directory argument.
+
+    Returns
+    -------
+    Union[Path, None]
+        The directory path, or None if the argument is empty.
+
+    """
+    value = value.strip()
+    if not value:
+        return None
+    return Path(value)
 
         
 def parse_arguments() -> argparse.Namespace:
@@ -40,6 +70,11 @@ def parse_arguments() -> argparse.Namespace:
                         'descriptions are available for each patient. Requires' +
                         ' source directory.')
     
+    parser.add_argument('--summary', action='store_true',
+                        help='Runs both the descriptions and the sequence' +
+                        ' overview operations, reading the sorted directory' +
+                        ' once. Requires source directory.')
+    
     parser.add_argument('-v', '--validate', action='store_true', help='Validates' +
                         ' the files between the anonymised and sorted directory.' +
                         ' Requires source and target directories.')
@@ -48,100 +83,178 @@ def parse_arguments() -> argparse.Namespace:
                         help='Catalogues and visualises the sequqnce descriptors' +
                         ' for the data. Requires source directory.')
     
-    parser.add_argument('--source', nargs='?', default='',
+    parser.add_argument('--source', nargs='?', type=directory_path, default=None,
                         help='The source directory path (read-only).')
                         
-    parser.add_argument('--target', nargs='?', default='',
+    parser.add_argument('--target', nargs='?', type=directory_path, default=None,
                         help='The target directory path (create/modify).')
+    
+    parser.add_argument('--workers', type=int, default=None,
+                        help='The number of worker processes used by the ' +
+                        'anonymisation. Defaults to the number of processors.')
+    
+    parser.add_argument('--full', action='store_true',
+                        help='Anonymises all the files again, including those ' +
+                        'anonymised (and not modified since) by previous executions.')
+    
+    parser.add_argument('--threads', type=int, default=None,
+                        help='The number of threads used by the sort and ' +
+                        'validate operations. Defaults to four times the ' +
+                        'number of processors (at most 32).')
+    
+    parser.add_argument('--link-mode', choices=['reflink', 'hardlink', 'copy'],
+                        default='copy', help='How the sort operation places ' +
+                        'the files in the target directory. Unsupported modes ' +
+                        'fall back to the next one, in the listed order. ' +
+                        'Hard linked files share their data with the source ' +
+                        'files. Defaults to copy.')
+    
+    parser.add_argument('--pin', action='store_true',
+                        help='Pins each worker of the anonymise and sort ' +
+                        'operations to a single processor, and limits the ' +
+                        'numeric libraries (OpenMP, MKL) to a single thread.')
+    
+    parser.add_argument('--checksum', action='store_true',
+                        help='Additionally compares the file contents (SHA-256 ' +
+                        'digests) in the validate operation.')
+    
+    parser.add_argument('--verbose', action='store_true',
+                        help='Logs the executed operation and its duration.')
+    
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='Does not print the progress of the sort and ' +
+                        'catalogue operations.')
                         
     args = parser.parse_args()
+    
+    # Check the directories of the operation before anything is executed
+    for operation_name, directories in required_directories.items():
+        if not getattr(args, operation_name):
+            continue
+        for directory_name, must_exist in directories.items():
+            directory = getattr(args, directory_name)
+            if directory is None:
+                parser.error("'{}' is required for '{}' operation.".format(directory_name,
+                                                                          operation_name))
+            if must_exist and not directory.is_dir():
+                parser.error("'{}' directory '{}' does not exist.".format(directory_name,
+                                                                       directory))
+        break
+        
     return args
 
 
-def anonymise(source_directory: str, target_directory: str) -> None:
+def anonymise(source_directory: Path, target_directory: Path,
+              workers: Union[int, None] = None, incremental: bool = True,
+              advise: bool = True, pin: bool = False) -> None:
     """
     Executes DICOM anonymise function.
 
     Parameters
     ----------
-    source_directory : str
+    source_directory : Path
         The directory containing the original DICOM files.
-    target_directory : str
+    target_directory : Path
         The destination directory in which the anonymised DICOM files will be
         copied to.
+    workers : Union[int, None], optional
+        The number of worker processes. The default is None, which uses the
+        number of processors on the machine.
+    incremental : bool, optional
+        Whether to skip the files already anonymised by previous executions.
+        The default is True.
+    advise : bool, optional
+        Whether to advise the kernel not to keep the source and anonymised
+        files in the page cache. The default is True.
+    pin : bool, optional
+        Whether to pin each worker process to a single processor. The default
+        is False.
 
     Returns
     -------
     None
 
     """
-    if not source_directory:
-        print("'source' is required for 'anonymise' operation.")
-    if not target_directory:
-        print("'target' is required for 'anonymise' operation.")
-        
+    from functions import anonymise_mri
+    
     anonymisation = anonymise_mri.Anonymisation('record_linkage.json',
-                                                Path(source_directory),
-                                                Path(target_directory))
-    anonymisation.anonymise()
+                                                source_directory,
+                                                target_directory)
+    anonymisation.anonymise(workers=workers, incremental=incremental, advise=advise,
+                            pin=pin)
     
 
-def sort(source_directory: str, target_directory: str) -> None:
+def sort(source_directory: Path, target_directory: Path,
+         threads: Union[int, None] = None, link_mode: str = 'copy',
+         progress: bool = True, pin: bool = False) -> None:
     """
     Executes DICOM sort function.
 
     Parameters
     ----------
-    source_directory : str
+    source_directory : Path
         The directory containing the unsorted DICOM files.
-    target_directory : str
+    target_directory : Path
         The destination directory in which the sorted DICOM files will be
         copied to.
+    threads : Union[int, None], optional
+        The number of threads sorting the files. The default is None, which
+        uses four times the number of processors (at most 32).
+    link_mode : str, optional
+        How the files are placed in the target directory: 'reflink',
+        'hardlink' or 'copy'. The default is 'copy'.
+    progress : bool, optional
+        Whether to print the progress. The default is True.
+    pin : bool, optional
+        Whether to pin each sorting thread to a single processor. The default
+        is False.
 
     Returns
     -------
     None
 
     """
-    if not source_directory:
-        print("'source' is required for 'sort' operation.")
-    if not target_directory:
-        print("'target' is required for 'sort' operation.")
+    from functions import dicom_sort
     
-    dicom_sort.sort(Path(source_directory), Path(target_directory))
+    dicom_sort.sort(source_directory, target_directory, threads, link_mode, progress, pin)
     
 
-def validate(source_directory: str, target_directory: str) -> None:
+def validate(source_directory: Path, target_directory: Path,
+             threads: Union[int, None] = None, checksum: bool = False) -> None:
     """
     Executes sort validation function.
 
     Parameters
     ----------
-    source_directory : str
+    source_directory : Path
         The directory containing the unsorted DICOM files.
-    target_directory : str
+    target_directory : Path
         The directory containing the sorted DICOM files.
+    threads : Union[int, None], optional
+        The number of threads counting the files. The default is None, which
+        uses four times the number of processors (at most 32).
+    checksum : bool, optional
+        Whether to also compare the file contents, through their SHA-256
+        digests. The default is False.
 
     Returns
     -------
     None
 
     """
-    if not source_directory:
-        print("'source' is required for 'validate' operation.")
-    if not target_directory:
-        print("'target' is required for 'validate' operation.")
-        
-    dicom_sort.validate(Path(source_directory), Path(target_directory))
+    from functions import dicom_sort
+    
+    dicom_sort.validate(source_directory, target_directory, threads,
+                        'sha256' if checksum else None)
     
 
-def descriptions(source_directory: str) -> None:
+def descriptions(source_directory: Path) -> None:
     """
     Executes sequence descriptions functoin, storing results into a csv file.
 
     Parameters
     ----------
-    source_directory : str
+    source_directory : Path
         The sorted direcotry.
 
     Returns
@@ -149,20 +262,19 @@ def descriptions(source_directory: str) -> None:
     None
 
     """
-    if not source_directory:
-        print("'source' is required for 'descriptions' operation.")
-        
-    unique_descriptions = sequence.get_descriptions(Path(source_directory))
+    from functions import sequence
+    
+    unique_descriptions = sequence.get_descriptions(source_directory)
     sequence.create_csv_descriptions(unique_descriptions)
 
 
-def rename(target_directory: str) -> None:
+def rename(target_directory: Path) -> None:
     """
     Executes rename function.
 
     Parameters
     ----------
-    target_directory : str
+    target_directory : Path
         The sorted directory.
 
     Returns
@@ -170,19 +282,18 @@ def rename(target_directory: str) -> None:
     None
 
     """
-    if not target_directory:
-        print("'target' is required for 'rename' operation.")
+    from functions import sequence
     
-    sequence.rename_descriptors(Path(target_directory), None)
+    sequence.rename_descriptors(target_directory, None)
     
     
-def sequence_overview(source_directory: str) -> None:
+def sequence_overview(source_directory: Path) -> None:
     """
     Executes patient sequence descriptions overview function.
 
     Parameters
     ----------
-    source_directory : str
+    source_directory : Path
         The sorted directory.
 
     Returns
@@ -190,56 +301,100 @@ def sequence_overview(source_directory: str) -> None:
     None
 
     """
-    if not source_directory:
-        print("'source' is required for 'sequence_overview' operation.")
-        
-    sequence.create_html_csv_table(Path(source_directory))
+    from functions import sequence
+    
+    sequence.create_html_csv_table(source_directory)
     
     
-def catalogue_overview(source_directory: str) -> None:
+def summary(source_directory: Path) -> None:
+    """
+    Executes the descriptions and patient sequence descriptions overview
+    functions together, reading the sorted directory once.
+
+    Parameters
+    ----------
+    source_directory : Path
+        The sorted directory.
+
+    Returns
+    -------
+    None
+
     """
+    from functions import sequence
     
+    sequence.summarise(source_directory)
+    
+    
+def catalogue_overview(source_directory: Path, progress: bool = True) -> None:
+    """
+    Executes catalogue overview function.
 
     Parameters
     ----------
-    source_directory : str
-        DESCRIPTION.
+    source_directory : Path
+        The sorted directory.
+    progress : bool, optional
+        Whether to print the progress. The default is True.
 
     Returns
     -------
     None
 
     """
-    if not source_directory:
-        print("'source' is required for 'catalogue' operation.")
-        
-    catalogue.overview(source_directory)
+    from functions import catalogue
+    
+    catalogue.overview(source_directory, progress)
+    
+    
+# The operation of each flag, in order of precedence, with the way its
+# arguments are taken from the parsed arguments
+operations = {
+    'anonymise': lambda args: anonymise(args.source, args.target, args.workers,
+                                        not args.full, pin=args.pin),
+    'sort': lambda args: sort(args.source, args.target, args.threads,
+                              args.link_mode, not args.quiet, args.pin),
+    'validate': lambda args: validate(args.source, args.target, args.threads,
+                                      args.checksum),
+    'descriptions': lambda args: descriptions(args.source),
+    'rename': lambda args: rename(args.target),
+    'sequence_overview': lambda args: sequence_overview(args.source),
+    'summary': lambda args: summary(args.source),
+    'catalogue': lambda args: catalogue_overview(args.source, not args.quiet)
+    }
+    
+    
+# The directories required by each operation, and whether they must exist
+required_directories = {
+    'anonymise': {'source': True, 'target': False},
+    'sort': {'source': True, 'target': False},
+    'validate': {'source': True, 'target': True},
+    'descriptions': {'source': True},
+    'rename': {'target': True},
+    'sequence_overview': {'source': True},
+    'summary': {'source': True},
+    'catalogue': {'source': True}
+    }
     
     
 if __name__ == '__main__':
     args = parse_arguments()
     
-    if args.anonymise:
-        anonymise(args.source.strip(), args.target.strip())
-        print("Finished executing 'anonymise'.")
-    elif args.sort:
-        sort(args.source.strip(), args.target.strip())
-        print("Finished executing 'sort'.")
-    elif args.validate:
-        validate(args.source.strip(), args.target.strip())
-        print("Finished executing 'validate'.")
-    elif args.descriptions:
-        descriptions(args.source.strip())
-        print("Finished executing 'descriptions'.")
-    elif args.rename:
-        rename(args.target.strip())
-        print("Finished executing 'rename'.")
-    elif args.sequence_overview:
-        sequence_overview(args.source.strip())
-        print("Finished executing 'sequence_overview'.")
-    elif args.catalogue:
-        catalogue_overview(args.source.strip())
-        print("Finished executing 'catalogue'.")
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+                        level=logging.INFO if args.verbose else logging.WARNING)
+    
+    if args.pin:
+        # Read by the numeric libraries when they are loaded, so these are set
+        # before any operation module is imported and are inherited by the
+        # worker processes
+        os.environ.setdefault('OMP_NUM_THREADS', '1')
+        os.environ.setdefault('MKL_NUM_THREADS', '1')
+    
+    for operation_name, operation in operations.items():
+        if getattr(args, operation_name):
+            start_time = time.perf_counter()
+            operation(args)
+            logger.info("Finished '%s' in %.2fs", operation_name, time.perf_counter() - start_time)
+            break
     else:
         print('No flags passed. Terminating...')
-